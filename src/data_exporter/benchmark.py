@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""Throughput benchmarks for the csv <-> database paths.
+
+Generates deterministic csv files in the shared schema and runs them through the converters against
+local stand-ins: mongomock (or a local mongod with --mongo-uri) and SQLite for the SQLAlchemy path.
+Results are written as JSON, pass an earlier result file with --compare to see the change per harness.
+
+    python benchmark.py --rows 100k --duplicates 0.1
+    python benchmark.py --rows 1m --harness mysql --compare bench/results-100k.json
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import platform
+import random
+import time
+from contextlib import contextmanager
+from multiprocessing import Pool
+
+from metrics import peak_rss_mb
+from schema import FIELD_NAMES
+
+logger = logging.getLogger(__name__)
+
+BENCH_DIR = './bench'
+SIZES = {'100k': 100000, '1m': 1000000, '10m': 10000000}
+DUPLICATE_RATE = 0.1
+SEED = 42
+# long free text follows a log-normal length distribution, (median, sigma) in characters
+TEXT_LENGTHS = {
+    'site_description': (300, 1.2),
+    'working_hours_old_format': (150, 0.8),
+    'site_keywords': (80, 1.0),
+    'subtypes': (40, 0.6),
+}
+MAX_TEXT = 50000
+# rows kept as candidates for duplicates, bounds the generator's memory
+DUPLICATE_POOL = 100000
+HARNESSES = ('mongo', 'mysql')
+
+WORDS = ('restaurant cafe bakery grocery pharmacy salon dentist clinic garage hotel bar gym florist tailor '
+         'open daily delivery parking wifi family owned since organic local fresh coffee pizza sushi vegan '
+         'monday tuesday wednesday thursday friday saturday sunday am pm closed service quality best price').split()
+CITIES = [('New York', 'NY', '100'), ('Los Angeles', 'CA', '900'), ('Chicago', 'IL', '606'),
+          ('Houston', 'TX', '770'), ('Phoenix', 'AZ', '850'), ('Philadelphia', 'PA', '191'),
+          ('San Antonio', 'TX', '782'), ('San Diego', 'CA', '921'), ('Dallas', 'TX', '752'),
+          ('Austin', 'TX', '787'), ('Seattle', 'WA', '981'), ('Denver', 'CO', '802')]
+STREETS = ['Main', 'Oak', 'Pine', 'Maple', 'Cedar', 'Elm', 'Washington', 'Lake', 'Hill', 'Park']
+
+
+def size_arg(value):
+    return SIZES.get(value.lower()) or int(value)
+
+
+class TextSource:
+    """Slices long text out of one pregenerated corpus, so megabytes of text cost no per-word work."""
+
+    def __init__(self, rng, size=MAX_TEXT * 2):
+        words = []
+        length = 0
+        while length < size:
+            word = rng.choice(WORDS)
+            words.append(word)
+            length += len(word) + 1
+        self.corpus = ' '.join(words)
+
+    def text(self, rng, median, sigma):
+        length = min(MAX_TEXT, int(rng.lognormvariate(0, sigma) * median))
+        start = rng.randrange(len(self.corpus) - length)
+        return self.corpus[start:start + length]
+
+
+def generate_csv(path, rows, duplicate_rate=DUPLICATE_RATE, seed=SEED):
+    """Writes `rows` business rows in the shared schema, the same seed always gives the same file.
+    About `duplicate_rate` of the rows repeat the Name and full_address of an earlier row.
+    """
+    rng = random.Random(seed)
+    texts = TextSource(rng)
+    pool = []
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        writer.writerow(FIELD_NAMES)
+        for i in range(rows):
+            if pool and rng.random() < duplicate_rate:
+                name, full_address, city, state, postal_code = rng.choice(pool)
+            else:
+                city, state, prefix = rng.choice(CITIES)
+                postal_code = '{}{:02d}'.format(prefix, rng.randrange(100))
+                name = '{} {} {}'.format(rng.choice(WORDS).title(), rng.choice(WORDS).title(), i)
+                full_address = '{} {} St, {}, {} {}'.format(rng.randrange(1, 9999), rng.choice(STREETS), city,
+                                                            state, postal_code)
+                if len(pool) < DUPLICATE_POOL:
+                    pool.append((name, full_address, city, state, postal_code))
+                else:
+                    pool[rng.randrange(DUPLICATE_POOL)] = (name, full_address, city, state, postal_code)
+
+            values = {
+                'Name': name,
+                'Website': 'https://www.example{}.com'.format(i),
+                'Type': rng.choice(WORDS).title(),
+                'Phone': '+1 {:03d}-{:03d}-{:04d}'.format(rng.randrange(200, 999), rng.randrange(1000),
+                                                          rng.randrange(10000)),
+                'full_address': full_address,
+                'street': full_address.split(',')[0],
+                'city': city,
+                'postal_code': postal_code,
+                'country': 'United States',
+                'latitude': '{:.7f}'.format(rng.uniform(25, 49)),
+                'longitude': '{:.7f}'.format(rng.uniform(-124, -67)),
+                'time_zone': 'America/New_York',
+                'rating': '{:.1f}'.format(rng.uniform(1, 5)),
+                'reviews': str(int(rng.paretovariate(1.2))),
+                'verified': rng.choice(('TRUE', 'FALSE')),
+                'location_link': 'https://maps.example.com/?cid={}'.format(rng.getrandbits(60)),
+                'email': 'info@example{}.com'.format(i) if rng.random() < 0.4 else '',
+            }
+            for field, (median, sigma) in TEXT_LENGTHS.items():
+                values[field] = texts.text(rng, median, sigma)
+            writer.writerow([values.get(field, '') for field in FIELD_NAMES])
+
+
+class Phases:
+    def __init__(self):
+        self.seconds = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+
+
+def result(rows, phases, metrics=None):
+    seconds = sum(phases.seconds.values())
+    return {
+        'rows': rows,
+        'seconds': seconds,
+        'rows_per_sec': rows / seconds if seconds else None,
+        'phases': phases.seconds,
+        # where the converter itself spent the time
+        'stages': dict(metrics.stages) if metrics else {},
+    }
+
+
+def bench_mongo(csv_path, rows, work_dir, mongo_uri=None, writers=0):
+    """CSV -> Mongo then Mongo -> CSV on the same collection."""
+    import pymongo
+    import csv_to_mongodb
+    import mongo_to_csv
+
+    if mongo_uri:
+        csv_to_mongodb.MONGO_URI = mongo_to_csv.MONGO_URI = mongo_uri
+    else:
+        import mongomock
+        client = mongomock.MongoClient()
+        pymongo.MongoClient = mongo_to_csv.MongoClient = lambda *args, **kwargs: client
+    # never touch the real data
+    csv_to_mongodb.MONGO_DATABASE = mongo_to_csv.MONGO_DATABASE = 'benchmark'
+
+    ingest = Phases()
+    with ingest.phase('setup'):
+        converter = csv_to_mongodb.CsvToDbConverter(csv_path, checkpoint_dir=None, writers=writers)
+        converter.__enter__()
+    try:
+        converter.collection.delete_many({})
+        with ingest.phase('ingest'):
+            if not converter.process_data():
+                raise RuntimeError('Ingest failed: {}'.format(csv_path))
+        if mongo_uri:
+            # mongomock scans the whole collection for every delete, its dedup time says nothing
+            with ingest.phase('dedup'):
+                converter.remove_duplicates(csv_path)
+        stored = converter.collection.count_documents({})
+    finally:
+        converter.__exit__(None, None, None)
+
+    export = Phases()
+    output_csv = os.path.join(work_dir, 'mongo_export.csv')
+    with export.phase('export'):
+        with mongo_to_csv.MongoToFile(output_csv) as exporter:
+            exported = exporter.export_to_csv()
+
+    return {
+        'csv_to_mongo': dict(result(rows, ingest, converter.metrics), stored=stored),
+        'mongo_to_csv': result(exported, export, exporter.metrics),
+    }
+
+
+def bench_mysql(csv_path, rows, work_dir, loader='core', writers=0):
+    """CSV -> SQLAlchemy then SQLAlchemy -> CSV on a SQLite file."""
+    from sqlalchemy import create_engine
+    import csv_to_mysql
+
+    db_path = os.path.join(work_dir, 'benchmark.db')
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    engine = create_engine('sqlite:///{}'.format(db_path), connect_args={'timeout': 60})
+
+    ingest = Phases()
+    with ingest.phase('setup'):
+        converter = csv_to_mysql.CsvToDbConverter(csv_path, loader=loader, engine=engine, checkpoint_dir=None,
+                                                  writers=writers)
+        converter.__enter__()
+    try:
+        with ingest.phase('ingest'):
+            if not converter.process_data():
+                raise RuntimeError('Ingest failed: {}'.format(csv_path))
+        ingest_metrics = converter.metrics
+    finally:
+        converter.__exit__(None, None, None)
+
+    export = Phases()
+    output_dir = os.path.join(work_dir, 'mysql_export')
+    with csv_to_mysql.CsvToDbConverter(engine=engine) as converter:
+        with export.phase('split'):
+            ranges = converter.split_ranges(max(rows, 1))
+        with export.phase('export'):
+            manifest = converter.export_partitioned(max(rows, 1), workers=1, output_dir=output_dir)
+
+    return {
+        'csv_to_mysql': dict(result(rows, ingest, ingest_metrics), stored=manifest['total_rows'],
+                             partitions=len(ranges)),
+        'mysql_to_csv': result(manifest['total_rows'], export),
+    }
+
+
+def run_harness(task):
+    name, csv_path, rows, work_dir, options = task
+    if name == 'mongo':
+        results = bench_mongo(csv_path, rows, work_dir, options.get('mongo_uri'), options.get('writers', 0))
+    else:
+        results = bench_mysql(csv_path, rows, work_dir, options.get('loader', 'core'), options.get('writers', 0))
+
+    # peak of this worker process, each harness gets a fresh one
+    rss = peak_rss_mb()
+    for value in results.values():
+        value['peak_rss_mb'] = rss
+    return results
+
+
+def run(rows, duplicate_rate=DUPLICATE_RATE, seed=SEED, harnesses=HARNESSES, work_dir=BENCH_DIR, **options):
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir, exist_ok=True)
+
+    csv_path = os.path.join(work_dir, 'bench-{}-{}-{}.csv'.format(rows, duplicate_rate, seed))
+    generated = None
+    if not os.path.exists(csv_path):
+        start = time.perf_counter()
+        generate_csv(csv_path, rows, duplicate_rate, seed)
+        generated = time.perf_counter() - start
+        logger.info('Generated {} rows in {:.1f}s: {}'.format(rows, generated, csv_path))
+
+    results = {}
+    for name in harnesses:
+        with Pool(processes=1, maxtasksperchild=1) as pool:
+            results.update(pool.apply(run_harness, ((name, csv_path, rows, work_dir, options),)))
+        logger.info('Finished harness: {}'.format(name))
+
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': dict(options, rows=rows, duplicate_rate=duplicate_rate, seed=seed,
+                       csv_bytes=os.path.getsize(csv_path), generate_seconds=generated),
+        'results': results,
+    }
+
+
+def compare(previous, current):
+    """Logs the throughput change of every harness present in both runs."""
+    for name, value in sorted(current['results'].items()):
+        before = previous.get('results', {}).get(name)
+        if not before or not before.get('rows_per_sec') or not value.get('rows_per_sec'):
+            continue
+        change = value['rows_per_sec'] / before['rows_per_sec'] - 1
+        logger.info('{}: {:.0f} -> {:.0f} rows/s ({:+.1%})'.format(
+            name, before['rows_per_sec'], value['rows_per_sec'], change))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=size_arg, default=SIZES['100k'], help='100k, 1m, 10m or a row count')
+    parser.add_argument('--duplicates', type=float, default=DUPLICATE_RATE, help='share of duplicate rows')
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--harness', choices=HARNESSES, action='append', help='default: all')
+    parser.add_argument('--mongo-uri', help='local mongod instead of mongomock')
+    parser.add_argument('--loader', default='core', help='csv_to_mysql loader: orm or core')
+    parser.add_argument('--writers', type=int, default=0, help='pipeline writer threads')
+    parser.add_argument('--work-dir', default=BENCH_DIR)
+    parser.add_argument('--output', help='result json, default: <work-dir>/results-<rows>.json')
+    parser.add_argument('--compare', help='earlier result json to compare with')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    # only the benchmark's own progress, not every batch
+    logging.getLogger().setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    report = run(args.rows, args.duplicates, args.seed, args.harness or HARNESSES, args.work_dir,
+                 mongo_uri=args.mongo_uri, loader=args.loader, writers=args.writers)
+
+    output = args.output or os.path.join(args.work_dir, 'results-{}.json'.format(args.rows))
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report['results'], indent=2))
+    logger.info('Results written to: {}'.format(output))
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(json.load(f), report)
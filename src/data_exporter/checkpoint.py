@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+
+try:
+    from bson import json_util
+except ImportError:
+    json_util = json
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_DIR = './checkpoints'
+
+
+class Checkpoint:
+    """Last committed position of an input file, so an interrupted ingest resumes after the last batch.
+
+    Each input file has its own small json file, replaced atomically, so parallel workers never contend.
+    A checkpoint is ignored once the input file's size or mtime changed.
+    """
+
+    def __init__(self, input_csv, directory=CHECKPOINT_DIR):
+        self.input_csv = input_csv
+        name = hashlib.sha1(os.path.abspath(input_csv).encode('utf-8')).hexdigest()
+        self.path = os.path.join(directory, name + '.json')
+        stat = os.stat(input_csv)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+    def load(self):
+        """Returns the (byte offset, row index) to resume from, (0, 0) to start over."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return 0, 0
+
+        if data.get('size') != self.size or data.get('mtime') != self.mtime:
+            logger.warning('Input changed since the last checkpoint, starting over: {}'.format(self.input_csv))
+            return 0, 0
+
+        logger.info('Resuming {} from row {} (byte {}).'.format(self.input_csv, data['row'], data['offset']))
+        return data['offset'], data['row']
+
+    def save(self, offset, row):
+        data = {
+            'file': self.input_csv,
+            'size': self.size,
+            'mtime': self.mtime,
+            'offset': offset,
+            'row': row,
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Watermark:
+    """Last committed position of a database scan, e.g. the last _id or primary key copied, so an interrupted
+    transfer or export resumes after it. Stored like `Checkpoint` in a json file named after the scan,
+    through bson's json_util so ObjectIds and datetimes survive the round trip.
+    """
+
+    def __init__(self, name, directory=CHECKPOINT_DIR):
+        self.name = name
+        self.path = os.path.join(directory, hashlib.sha1(name.encode('utf-8')).hexdigest() + '.json')
+
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+    def load(self):
+        """Returns the (position, rows) saved last, (None, 0) to start over."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json_util.loads(f.read())
+        except (OSError, ValueError):
+            return None, 0
+
+        logger.info('Resuming {} after {} ({} rows).'.format(self.name, data['position'], data['rows']))
+        return data['position'], data['rows']
+
+    def save(self, position, rows):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json_util.dumps({'name': self.name, 'position': position, 'rows': rows}))
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class OffsetReader:
+    """Iterates the lines of a binary file as text and tracks the byte offset consumed so far.
+    csv.reader only pulls the lines of the record it returns, so after each row `offset` is its end.
+    """
+
+    def __init__(self, f, encoding='utf-8', errors='ignore'):
+        self.f = f
+        self.encoding = encoding
+        self.errors = errors
+        self.offset = f.tell()
+
+    def __iter__(self):
+        for line in self.f:
+            self.offset += len(line)
+            yield line.decode(self.encoding, self.errors)
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""Ingest loop shared by csv_to_mongodb and csv_to_mysql, each script keeps only its target."""
+import csv
+import logging
+import os
+from functools import partial
+from logging.handlers import RotatingFileHandler
+from multiprocessing import Pool, Semaphore, Value
+
+from checkpoint import Checkpoint, OffsetReader
+from dedup_index import digest, make_hash
+from ingest_manifest import IngestManifest
+from metrics import Metrics, metrics_path, profiled
+from parallel_csv import ChunkedCsvReader
+from pipeline import AdaptiveBatcher, BatchPipeline
+from schema import RowMapper, TypedFields, encoded_size
+from watch import POLL_INTERVAL, DirectoryWatcher
+
+logger = logging.getLogger(__name__)
+
+
+def setup_logger():
+    logger.setLevel(logging.DEBUG)
+
+    # create formatter and add it to the handlers
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    # create file handler which logs even debug messages
+    fh = RotatingFileHandler('csv_cleaner.log', maxBytes=10 * 1024 * 1024, backupCount=5)
+    fh.setLevel(logging.INFO)
+    fh.setFormatter(formatter)
+
+    # create console handler with a higher log level
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    ch.setFormatter(formatter)
+
+    # add the handlers to the logger
+    logger.addHandler(fh)
+    logger.addHandler(ch)
+
+
+def file_profile(input_file, profile, profile_file):
+    # only the one file asked for is profiled
+    return profile if profile_file and os.path.basename(input_file) == profile_file else None
+
+
+class CsvIngester:
+    """Base of the csv converters, runs the ingest loop for any target: checkpoints, dedup lookups,
+    adaptive batches, the write pipeline and the run metrics.
+
+    Subclasses provide the target. `dedup_keys()` returns the keys of the stored rows, anything answering `in`
+    and `update`, or None to skip the lookup. `open_writer()` returns the (load, close) pair of a pipeline writer,
+    its load returns the number of rows the target rejected. `to_item(record, hash)` builds what is written for
+    a row and `row_overhead()` its bytes beyond the values. `remove_file(file)` and `rebuild_dedup_index(path)`
+    let a modified file replace its rows.
+    """
+    metrics_name = None
+
+    def __init__(self, input_csv, checkpoint_dir, typed, writers, max_batch_bytes, max_batch_rows,
+                 metrics_callbacks, metrics_path, profile, parse_workers):
+        if input_csv:
+            self.input_csv = input_csv + '.csv' if not str(input_csv).lower().endswith('.csv') else input_csv
+        else:
+            self.input_csv = None
+        self.typed = typed
+        self.mapper = RowMapper()
+        # text column widths typed rows are checked against, None when unbounded
+        self.widths = None
+        self.metrics = None
+        self.__checkpoint_dir = checkpoint_dir
+        self.__writers = writers
+        self.__max_batch_bytes = max_batch_bytes
+        self.__max_batch_rows = max_batch_rows
+        self.__metrics_callbacks = metrics_callbacks
+        self.__metrics_path = metrics_path
+        self.__profile = profile
+        self.__parse_workers = parse_workers
+
+    def claim(self, keys):
+        """Returns the keys of a batch which another worker stored first, none unless workers share a run index."""
+        return set()
+
+    def process_data(self):
+        """Ingests the input csv, returns False if the file could not be processed.
+        Metrics of the run are kept in `metrics`, passed to the callbacks and written to the metrics path.
+        """
+        self.metrics = Metrics(self.metrics_name, {'file': self.input_csv}, self.__metrics_callbacks)
+        with profiled(self.__profile, os.path.splitext(self.input_csv)[0]):
+            ok = self.__process_data(self.metrics)
+        if not ok:
+            self.metrics.incr('failed')
+        self.metrics.finish(metrics_path(self.__metrics_path, self.input_csv))
+        return ok
+
+    def ingest(self, input_csv, profile=None):
+        """Ingests another input csv with the connection and setup of this converter, so a long running
+        process pays them once. Returns False if the file could not be processed.
+        """
+        self.input_csv = input_csv
+        self.__profile = profile
+        try:
+            return self.process_data()
+        finally:
+            logger.info('=== Finish processing: {} ==='.format(input_csv))
+            self.input_csv = None
+
+    def replace_files(self, input_files, dedup_index_path=None):
+        """Deletes the rows of modified input files before they are ingested again.
+        The persistent dedup index is rebuilt afterwards, or when it is missing, so the keys of removed rows
+        do not block their re-insert.
+        """
+        for input_file in input_files:
+            self.remove_file(input_file)
+
+        if dedup_index_path and (input_files or not os.path.exists(dedup_index_path)):
+            self.rebuild_dedup_index(dedup_index_path)
+
+    def watch(self, input_directory, manifest_path, dedup_index_path=None, poll_interval=POLL_INTERVAL,
+              profile=None, profile_file=None, on_ingested=None):
+        """Ingests csv files as they land in the input directory until SIGINT or SIGTERM.
+        New and modified files are taken as the manifest tells, `on_ingested(input_file)` runs after each.
+        """
+        manifest = IngestManifest(manifest_path)
+        watcher = DirectoryWatcher(input_directory, poll_interval=poll_interval)
+        for input_files in watcher:
+            new_files, modified_files = manifest.changed(input_files)
+            self.replace_files(modified_files, dedup_index_path)
+
+            for input_file in new_files + modified_files:
+                if self.ingest(input_file, file_profile(input_file, profile, profile_file)):
+                    manifest.record(input_file)
+                    manifest.save()
+
+                if on_ingested:
+                    on_ingested(input_file)
+
+    def __process_data(self, metrics):
+        try:
+            logger.info('=== Start processing: {} ==='.format(self.input_csv))
+            if os.path.exists(self.input_csv):
+                with metrics.stage('load_keys'):
+                    stored = self.dedup_keys()
+                checkpoint = Checkpoint(self.input_csv, self.__checkpoint_dir) if self.__checkpoint_dir else None
+                offset, index = checkpoint.load() if checkpoint else (0, 0)
+                rejected = 0
+                # keys of rows read but not stored yet, across all batches in flight
+                inflight = set()
+                batcher = AdaptiveBatcher(self.__max_batch_bytes, self.__max_batch_rows,
+                                          row_overhead=self.row_overhead())
+
+                def commit(result, token, seconds):
+                    nonlocal rejected
+                    keys, offset, row = token
+                    metrics.observe_flush(seconds, *batcher.observe(seconds))
+                    rejected += result or 0
+                    if stored is not None:
+                        stored.update(keys)
+                    inflight.difference_update(keys)
+                    if checkpoint:
+                        checkpoint.save(offset, row)
+
+                typed_fields = TypedFields(self.mapper.field_names, self.widths) if self.typed else None
+                ingest = self.__ingest_chunks if self.__parse_workers else self.__ingest_lines
+                laps = metrics.laps()
+                with BatchPipeline(self.open_writer, commit, self.__writers) as pipeline:
+                    duplicates = ingest(pipeline, batcher, stored, inflight, offset, index, typed_fields, laps,
+                                        metrics)
+                laps.lap('flush')
+                metrics.add_section('pipeline', pipeline.stats())
+                metrics.add_section('batches', batcher.stats())
+                metrics.incr('duplicates', duplicates)
+                metrics.incr('rejected_duplicates', rejected)
+
+                if checkpoint:
+                    checkpoint.clear()
+
+                if duplicates:
+                    logger.info('Skipped {} duplicate rows.'.format(duplicates))
+                if rejected:
+                    logger.info('Rejected {} duplicate rows by the unique hash index.'.format(rejected))
+                batcher.log_stats()
+                if typed_fields:
+                    typed_fields.report(self.input_csv)
+                    metrics.incr('rejected_rows', typed_fields.rejected_rows)
+                return True
+        except Exception as x:
+            logger.error('Error when process data: {}'.format(x))
+        return False
+
+    def __ingest_lines(self, pipeline, batcher, stored, inflight, offset, index, typed_fields, laps, metrics):
+        """Parses the input csv line by line and submits the batches, returns the number of duplicates skipped."""
+        duplicates = 0
+        with open(self.input_csv, 'rb') as f:
+            f.seek(offset)
+            lines = OffsetReader(f)
+            reader = csv.reader(lines, quoting=csv.QUOTE_ALL)
+            buffer = []
+            keys = []
+            full = False
+            mapper = self.mapper
+            start_row = max(index, 1)
+            for row in reader:
+                laps.lap('read')
+                try:
+                    if index == 0 or not row:
+                        continue
+
+                    record = mapper.fit(row)
+                    if record is None:
+                        logger.warning('There are less than {} columns!'.format(mapper.min_columns))
+                        metrics.incr('short_rows')
+                        continue
+                    nbytes = encoded_size(record)
+
+                    hash = make_hash(*mapper.key(record))
+                    laps.lap('map')
+                    key = None
+                    if stored is not None:
+                        key = digest(hash)
+                        if key in stored or key in inflight:
+                            duplicates += 1
+                            continue
+                        laps.lap('dedup')
+
+                    if typed_fields:
+                        typed_fields.parse(record)
+                        laps.lap('typed')
+
+                    buffer.append(self.to_item(record, hash))
+                    full = batcher.add(nbytes)
+                    if key is not None:
+                        keys.append(key)
+                        inflight.add(key)
+                    laps.lap('build')
+                except Exception as ex:
+                    logger.error('Error processing each row: {}'.format(ex))
+                    metrics.incr('row_errors')
+                finally:
+                    index += 1
+
+                if full:
+                    # the checkpoint moves past these rows once the batch is stored
+                    duplicates += self.__submit(pipeline, buffer, keys, lines.offset, index)
+                    buffer = []
+                    keys = []
+                    full = False
+                    laps.lap('flush')
+
+            if batcher.flush():
+                duplicates += self.__submit(pipeline, buffer, keys, lines.offset, index)
+            metrics.incr('rows_read', max(index - start_row, 0))
+            metrics.incr('bytes_read', lines.offset - offset)
+        return duplicates
+
+    def __ingest_chunks(self, pipeline, batcher, stored, inflight, offset, index, typed_fields, laps, metrics):
+        """Parses the input csv in memory-mapped chunks over a process pool and submits the batches.
+        Rows arrive in file order, already fitted, hashed and typed, so the checkpoint stays exact.
+        Returns the number of duplicates skipped.
+        """
+        reader = ChunkedCsvReader(self.input_csv, offset, index, typed_fields is not None, self.__parse_workers,
+                                  widths=self.widths)
+        duplicates = 0
+        buffer = []
+        keys = []
+        for row, end, record, hash, key, nbytes in reader:
+            laps.lap('parse')
+            if stored is not None:
+                if key in stored or key in inflight:
+                    duplicates += 1
+                    continue
+                laps.lap('dedup')
+
+            buffer.append(self.to_item(record, hash))
+            full = batcher.add(nbytes)
+            if stored is not None:
+                keys.append(key)
+                inflight.add(key)
+            laps.lap('build')
+
+            if full:
+                duplicates += self.__submit(pipeline, buffer, keys, end, row)
+                buffer = []
+                keys = []
+                laps.lap('flush')
+
+        if batcher.flush():
+            duplicates += self.__submit(pipeline, buffer, keys, reader.offset, reader.index)
+        metrics.incr('rows_read', max(reader.index - max(index, 1), 0))
+        metrics.incr('bytes_read', reader.offset - offset)
+        reader.report(metrics, typed_fields)
+        return duplicates
+
+    def __submit(self, pipeline, buffer, keys, offset, row):
+        """Submits a batch, returns the number of its rows dropped because another worker claimed them first."""
+        dropped = 0
+        taken = self.claim(keys) if keys else None
+        if taken:
+            kept = [(item, key) for item, key in zip(buffer, keys) if key not in taken]
+            dropped = len(buffer) - len(kept)
+            buffer = [item for item, _ in kept]
+            keys = [key for _, key in kept]
+        pipeline.submit(buffer, (keys, offset, row))
+        return dropped
+
+
+def process_file(converter_class, input_file, profile=None, **kwargs):
+    """Ingests one file with a converter of its own, returns False if it could not be processed."""
+    try:
+        logger.info('Processing CSV: {}'.format(input_file))
+        with converter_class(input_file, profile=profile, **kwargs) as converter:
+            return converter.process_data()
+    except Exception as x:
+        logger.error('Error when process file: {}. Details: {}'.format(input_file, x))
+        return False
+
+
+def process_files(converter_class, input_files, workers, profile=None, profile_file=None, **kwargs):
+    """Ingests each file in its own worker process, the converters get `kwargs`.
+    A failing file is logged and skipped, the rest of the batch continues.
+    Returns the list of files which failed.
+    """
+    total = Value('i', 0)
+    lock = Semaphore()
+    tasks = [(input_file, file_profile(input_file, profile, profile_file)) for input_file in input_files]
+    with Pool(processes=workers, initializer=converter_class.init_worker, initargs=(total, lock)) as pool:
+        results = pool.starmap(partial(process_file, converter_class, **kwargs), tasks, chunksize=1)
+
+    failed = [input_file for input_file, ok in zip(input_files, results) if not ok]
+    logger.info('=== Inserted {} rows from {} files ({} failed) ==='.format(total.value, len(input_files), len(failed)))
+    return failed
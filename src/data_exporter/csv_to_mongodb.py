@@ -1,24 +1,55 @@
 #! -*- coding: utf-8 -*-
 
-import csv
 import datetime
 import glob
 import logging
 import os
 import re
-from collections import OrderedDict
 from logging.handlers import RotatingFileHandler
 from multiprocessing import Semaphore, Value
 
 import pymongo
 from pymongo import DeleteOne
+from pymongo.errors import BulkWriteError
 from sqlalchemy import create_engine, Column, Integer, UnicodeText, Unicode, func, inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+import csv_ingest
+from checkpoint import CHECKPOINT_DIR
+from csv_ingest import CsvIngester, file_profile
+from dedup_index import DedupIndex, digest
+from ingest_manifest import IngestManifest
+from schema import FIELD_NAMES, FLOAT_FIELDS, INT_FIELDS
+from watch import POLL_INTERVAL
+
 MONGO_URI = 'mongodb://localhost:27017'
 MONGO_DATABASE = 'data'
 MONGO_COLLECTION_NAME = 'items'
+# the reader and the pipeline writers need a handful of connections, not thousands
+MAX_POOL_SIZE = 16
+WORKERS = os.cpu_count() or 1
+USE_DEDUP_INDEX = False
+# one index per target, keys ingested into one database say nothing about the other
+DEDUP_INDEX_PATH = './csv_to_mongodb.dedup.idx'
+UNIQUE_HASH_INDEX = False
+DUPLICATE_KEY_ERROR = 11000
+DELETE_BATCH_SIZE = 1000
+INGEST_MANIFEST_PATH = './csv_to_mongodb.manifest.json'
+TYPED_SCHEMA = False
+# adaptive batches stay well under the 48 MB message limit and the 100000 writes per batch of the server
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+MAX_BATCH_ROWS = 100000
+# writer threads flushing batches while the next ones are parsed, 0 parses and writes in turn
+PIPELINE_WRITERS = 0
+# processes parsing memory-mapped chunks of one file, 0 parses it line by line in this process
+PARSE_WORKERS = 0
+NUMERIC_FIELDS = FLOAT_FIELDS + INT_FIELDS
+# per file run metrics, .json or a Prometheus textfile (.prom), {file} is the input file name
+METRICS_PATH = None
+# 'cprofile' or 'tracemalloc' for the input file named PROFILE_FILE, the report is written next to it
+PROFILE = None
+PROFILE_FILE = None
 
 logger = logging.getLogger(__name__)
 
@@ -44,15 +75,29 @@ def setup_logger():
     logger.addHandler(ch)
 
 
-class CsvToDbConverter:
+class CsvToDbConverter(CsvIngester):
+    metrics_name = 'csv_to_mongodb'
     __total = Value('i', 0)
     __lock = Semaphore()
 
-    def __init__(self, input_csv=None):
-        if input_csv:
-            self.__input_csv = input_csv + '.csv' if not str(input_csv).lower().endswith('.csv') else input_csv
-        else:
-            self.__input_csv = None
+    @staticmethod
+    def init_worker(total, lock):
+        # share the parent's counter and lock with pool workers
+        CsvToDbConverter.__total = total
+        CsvToDbConverter.__lock = lock
+
+    @classmethod
+    def get_total(cls):
+        return cls.__total.value
+
+    def __init__(self, input_csv=None, dedup_index_path=None, unique_hash=UNIQUE_HASH_INDEX,
+                 checkpoint_dir=CHECKPOINT_DIR, typed=TYPED_SCHEMA, writers=PIPELINE_WRITERS,
+                 max_batch_bytes=MAX_BATCH_BYTES, metrics_callbacks=None, metrics_path=METRICS_PATH, profile=None,
+                 parse_workers=PARSE_WORKERS):
+        super().__init__(input_csv, checkpoint_dir, typed, writers, max_batch_bytes, MAX_BATCH_ROWS,
+                         metrics_callbacks, metrics_path, profile, parse_workers)
+        self.__unique_hash = unique_hash
+        self.__dedup_index = DedupIndex(dedup_index_path) if dedup_index_path else None
 
         # set mongo credentials
         self.mongo_uri = MONGO_URI
@@ -60,19 +105,14 @@ class CsvToDbConverter:
         self.mongo_collection = MONGO_COLLECTION_NAME
 
     def __enter__(self):
-        self.__init()
-
         # initialize mongodb client
-        self.client = pymongo.MongoClient(self.mongo_uri, maxPoolSize=50000)
+        self.client = pymongo.MongoClient(self.mongo_uri, maxPoolSize=MAX_POOL_SIZE)
         self.db = self.client[self.mongo_db]
         self.collection = self.db[self.mongo_collection]
         # self.collection.create_index([("Name", pymongo.TEXT), ("full_address", pymongo.TEXT)], name='search_index',
         #                              unique=True)
         # self.collection.create_index("Name")
         # self.collection.create_index("full_address")
-        self.collection.create_index('hash')
-        self.collection.create_index('file')
-
         self.pipeline = [
             {
                 '$group': {
@@ -90,150 +130,222 @@ class CsvToDbConverter:
              }
         ]
         # self.collection.aggregate(pipeline)
+
+        self.__ensure_hash_index()
+        self.collection.create_index('file')
+        if self.typed:
+            # numeric fields are stored as BSON double/int, so range filters can use these
+            self.collection.create_index('rating')
+            self.collection.create_index([('latitude', pymongo.ASCENDING), ('longitude', pymongo.ASCENDING)])
+
+        if self.__dedup_index is not None:
+            self.__dedup_index.open()
         return self
 
-    def __init(self):
-        hdr = [('Name', 'Name'),
-               ('Website', 'Website'),
-               ('Type', 'Type'),
-               ('subtypes', 'subtypes'),
-               ('Phone', 'Phone'),
-               ('full_address', 'full_address'),
-               ('borough', 'borough'),
-               ('street', 'street'),
-               ('city', 'city'),
-               ('postal_code', 'postal_code'),
-               ('country', 'country'),
-               ('latitude', 'latitude'),
-               ('longitude', 'longitude'),
-               ('time_zone', 'time_zone'),
-               ('plus_code', 'plus_code'),
-               ('rating', 'rating'),
-               ('reviews', 'reviews'),
-               ('reviews_link', 'reviews_link'),
-               ('photo', 'photo'),
-               ('working_hours_old_format', 'working_hours_old_format'),
-               ('price_range', 'price_range'),
-               ('posts', 'posts'),
-               ('verified', 'verified'),
-               ('reserving_table_link', 'reserving_table_link'),
-               ('booking_appointment_link', 'booking_appointment_link'),
-               ('location_link', 'location_link'),
-               ('email', 'email'),
-               ('email2', 'email2'),
-               ('twitter', 'twitter'),
-               ('linkedin', 'linkedin'),
-               ('facebook', 'facebook'),
-               ('instagram', 'instagram'),
-               ('google_plus', 'google_plus'),
-               ('skype', 'skype'),
-               ('telegram', 'telegram'),
-               ('site_generator', 'site_generator'),
-               ('site_title', 'site_title'),
-               ('site_description', 'site_description'),
-               ('site_keywords', 'site_keywords')]
-
-        self.__csv_header = OrderedDict(hdr)
-        self.__field_names = list(self.__csv_header.keys())
+    def __ensure_hash_index(self):
+        if not self.__unique_hash:
+            self.collection.create_index('hash')
+            return
+
+        index = self.collection.index_information().get('hash_1')
+        if index and not index.get('unique'):
+            # existing duplicates would make the unique index build fail
+            logger.info('Replacing the hash index with a unique one.')
+            self.remove_duplicates()
+            self.collection.drop_index('hash_1')
+        self.collection.create_index('hash', unique=True)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.__input_csv:
-            logger.info('=== Finish processing: {} ==='.format(self.__input_csv))
+        if self.input_csv:
+            logger.info('=== Finish processing: {} ==='.format(self.input_csv))
+
+        if self.__dedup_index is not None:
+            self.__dedup_index.close()
 
         self.client.close()
         del self.client
         del self
 
-    def process_data(self):
-        try:
-            logger.info('=== Start processing: {} ==='.format(self.__input_csv))
-            if os.path.exists(self.__input_csv):
-                with open(self.__input_csv, 'r', errors='ignore') as f:
-                    reader = csv.reader(f, quoting=csv.QUOTE_ALL)
-                    index = 0
-                    buffer = []
-                    for row in reader:
-                        try:
-                            if index == 0 or not row:
-                                continue
-
-                            if len(row) < 13:
-                                logger.warning('There are less than 13 columns!')
-                                continue
-
-                            # old code
-                            # Create a zip object from two lists
-                            zip_data = zip(self.__field_names, row)
-                            # Create a dictionary from zip object
-                            data_dict = dict(zip_data)
-
-                            nm = data_dict['Name'].lower().strip() if 'Name' in data_dict else ''
-                            add = data_dict['full_address'].lower().strip() if 'full_address' in data_dict else ''
-                            data_dict['hash'] = nm + add
-                            data_dict['file'] = self.__input_csv
-
-                            # try:
-                            #     # if any([b for b in buffer if data_dict['Name'] == b['Name'] and
-                            #     #                              data_dict['full_address'] == b['full_address']]):
-                            #     #     logger.warning('item already exists!')
-                            #     #     continue
-                            #
-                            #     query = {'Name': re.compile(data_dict['Name'], re.IGNORECASE),
-                            #              'full_address': re.compile(data_dict['full_address'], re.IGNORECASE)}
-                            #     # q_data = self.collection.find(query)
-                            #     # if q_data and q_data.count() > 0:
-                            #     #     logger.warning('item inside database!')
-                            #     #     continue
-                            #
-                            #     q_data = self.collection.find_one(query)
-                            #     if q_data:
-                            #         logger.warning('item inside database!')
-                            #         continue
-                            # except:
-                            #     pass
-
-                            # new code
-                            buffer.append(data_dict)
-                            if len(buffer) % 1000 == 0:
-                                # # todo:
-                                # for document in self.collection.aggregate(self.pipeline):
-                                #     it = iter(document['uniqueIds'])
-                                #     next(it)
-                                #     for id in it:
-                                #         buffer.append(DeleteOne({'_id': id}))
-
-                                self.collection.insert_many(buffer)
-
-                                buffer = []
-                        except Exception as ex:
-                            logger.error('Error processing each row: {}'.format(ex))
-                        finally:
-                            index += 1
-        except Exception as x:
-            logger.error('Error when process data: {}'.format(x))
+    def __add_total(self, count):
+        with self.__lock:
+            self.__total.value += count
+
+    def insert(self, buffer):
+        """Inserts a batch and returns the number of rows rejected as duplicates.
+        With the unique hash index, duplicates are rejected by the server without aborting the batch.
+        """
+        if not self.__unique_hash:
+            self.collection.insert_many(buffer)
+            self.__add_total(len(buffer))
+            return 0
 
-    def remove_duplicates(self):
         try:
-            logger.info('====== Removing duplicates =======')
-            buffer = []
-            for document in self.collection.aggregate(self.pipeline):
-                it = iter(document['uniqueIds'])
-                next(it)
-                for id in it:
-                    buffer.append(DeleteOne({'_id': id}))
-
-            self.collection.bulk_write(buffer)
+            self.collection.insert_many(buffer, ordered=False)
+            self.__add_total(len(buffer))
+            return 0
+        except BulkWriteError as bwe:
+            errors = bwe.details.get('writeErrors', [])
+            rejected = sum(1 for error in errors if error.get('code') == DUPLICATE_KEY_ERROR)
+            self.__add_total(bwe.details.get('nInserted', 0))
+            if rejected < len(errors):
+                logger.error('Failed to insert {} rows. First error: {}'.format(
+                    len(errors) - rejected, next(e for e in errors if e.get('code') != DUPLICATE_KEY_ERROR)))
+            return rejected
+
+    def open_writer(self):
+        """Returns the (load, close) pair of a pipeline writer, every writer shares the thread safe client."""
+        return self.insert, None
+
+    def dedup_keys(self):
+        """Returns the persistent dedup index, None when the hashes are only deduplicated afterwards."""
+        return self.__dedup_index
+
+    def row_overhead(self):
+        # BSON adds the field names and a few bytes per value
+        return sum(len(name) + 7 for name in FIELD_NAMES) + 128
+
+    def to_item(self, record, hash):
+        """Builds the document of a row with its dedup hash and input file."""
+        data_dict = self.mapper.to_dict(record)
+        data_dict['hash'] = hash
+        data_dict['file'] = self.input_csv
+        if self.typed:
+            # empty or unparsable numbers are left out of the document
+            for field in NUMERIC_FIELDS:
+                if data_dict[field] is None:
+                    del data_dict[field]
+        return data_dict
+
+    def rebuild_dedup_index(self, path=DEDUP_INDEX_PATH):
+        """Rebuilds the persistent dedup index from the hashes stored in the collection."""
+        cursor = self.collection.find({}, projection={'hash': 1, '_id': 0}, batch_size=10000)
+        keys = (digest(doc.get('hash', '')) for doc in cursor)
+        if self.__dedup_index is not None and os.path.abspath(self.__dedup_index.path) == os.path.abspath(path):
+            # the open index is rebuilt in place and reopened
+            self.__dedup_index.rebuild(keys)
+            return
+        with DedupIndex(path) as index:
+            index.rebuild(keys)
+
+    def remove_file(self, file):
+        """Deletes every document ingested from the file, through the file index."""
+        result = self.collection.delete_many({'file': file})
+        logger.info('Removed {} documents of: {}'.format(result.deleted_count, file))
+
+    def remove_duplicates(self, file=None, batch_size=DELETE_BATCH_SIZE):
+        """Deletes all but one document of every duplicated hash.
+        With `file` only hashes touched by that input file are grouped, so the cost follows the new data
+        instead of the whole collection. Aggregations may spill to disk and deletes go out in bounded batches.
+        """
+        try:
+            logger.info('====== Removing duplicates {}======='.format('for: {} '.format(file) if file else ''))
+            removed = 0
+            for documents in self.__duplicate_groups(file, batch_size):
+                buffer = []
+                for document in documents:
+                    it = iter(document['uniqueIds'])
+                    next(it)
+                    for id in it:
+                        buffer.append(DeleteOne({'_id': id}))
+
+                    if len(buffer) >= batch_size:
+                        removed += self.__delete(buffer)
+                        logger.info('Removed: {} duplicates.'.format(removed))
+                        buffer = []
+
+                if buffer:
+                    removed += self.__delete(buffer)
+            logger.info('Removed {} duplicates.'.format(removed))
         except Exception as x:
             logger.error('Error when remove duplicates. Details: {}'.format(x))
 
+    def __duplicate_groups(self, file, batch_size):
+        if not file:
+            yield self.collection.aggregate(self.pipeline, allowDiskUse=True, batchSize=batch_size)
+            return
+
+        # group hashes of the file in chunks, each chunk is an index backed $in lookup
+        touched = self.collection.aggregate([{'$match': {'file': file}}, {'$group': {'_id': '$hash'}}],
+                                            allowDiskUse=True, batchSize=batch_size)
+        hashes = []
+        for document in touched:
+            hashes.append(document['_id'])
+            if len(hashes) >= batch_size:
+                yield self.__aggregate_hashes(hashes, batch_size)
+                hashes = []
+
+        if hashes:
+            yield self.__aggregate_hashes(hashes, batch_size)
+
+    def __aggregate_hashes(self, hashes, batch_size):
+        pipeline = [{'$match': {'hash': {'$in': hashes}}}] + self.pipeline
+        return self.collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+
+    def __delete(self, buffer):
+        return self.collection.bulk_write(buffer, ordered=False).deleted_count
+
+
+def process_files(input_files, workers=WORKERS, dedup_index_path=None):
+    """Ingests each file in its own worker process.
+    A failing file is logged and skipped, the rest of the batch continues.
+    Returns the list of files which failed.
+    """
+    return csv_ingest.process_files(CsvToDbConverter, input_files, workers, PROFILE, PROFILE_FILE,
+                                    dedup_index_path=dedup_index_path)
+
+
+def watch_files(input_directory, dedup_index_path=None, manifest_path=INGEST_MANIFEST_PATH,
+                poll_interval=POLL_INTERVAL):
+    """Daemon mode, ingests csv files as they land in the input directory until SIGINT or SIGTERM.
+    One converter keeps the client, the indexes and the dedup index for every file.
+    """
+    with CsvToDbConverter(dedup_index_path=dedup_index_path) as converter:
+        converter.watch(input_directory, manifest_path, dedup_index_path, poll_interval, PROFILE, PROFILE_FILE,
+                        None if UNIQUE_HASH_INDEX else converter.remove_duplicates)
+
+    if dedup_index_path:
+        with DedupIndex(dedup_index_path) as index:
+            index.compact()
+
 
 if __name__ == '__main__':
     setup_logger()
+    csv_ingest.setup_logger()
 
     input_directory = './csv_data'  # input('Please specify Input csv: ')
-    for input_file in glob.glob('{}/*.csv'.format(input_directory)):
-        logger.info('Processing CSV: {}'.format(input_file))
-        with CsvToDbConverter(input_file) as converter:
-            converter.process_data()
-
-            converter.remove_duplicates()
+    input_files = glob.glob('{}/*.csv'.format(input_directory))
+
+    # skip files ingested by an earlier run, replace the rows of modified ones
+    manifest = IngestManifest(INGEST_MANIFEST_PATH)
+    new_files, modified_files = manifest.changed(input_files)
+    input_files = new_files + modified_files
+    dedup_index_path = DEDUP_INDEX_PATH if USE_DEDUP_INDEX else None
+    with CsvToDbConverter() as converter:
+        converter.replace_files(modified_files, dedup_index_path)
+
+    if WORKERS > 1:
+        failed = process_files(input_files, WORKERS, dedup_index_path)
+        if not UNIQUE_HASH_INDEX:
+            with CsvToDbConverter() as converter:
+                for input_file in input_files:
+                    converter.remove_duplicates(input_file)
+    else:
+        failed = []
+        for input_file in input_files:
+            logger.info('Processing CSV: {}'.format(input_file))
+            with CsvToDbConverter(input_file, dedup_index_path,
+                                  profile=file_profile(input_file, PROFILE, PROFILE_FILE)) as converter:
+                if not converter.process_data():
+                    failed.append(input_file)
+
+                if not UNIQUE_HASH_INDEX:
+                    converter.remove_duplicates(input_file)
+
+    for input_file in input_files:
+        if input_file not in failed:
+            manifest.record(input_file)
+    manifest.save()
+
+    if dedup_index_path:
+        with DedupIndex(dedup_index_path) as index:
+            index.compact()
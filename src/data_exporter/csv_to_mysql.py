@@ -1,23 +1,65 @@
 #! -*- coding: utf-8 -*-
 
-import csv
 import datetime
 import glob
+import json
 import logging
 import os
-from collections import OrderedDict
+import random
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
 from logging.handlers import RotatingFileHandler
 from multiprocessing import Semaphore, Value
 
-from sqlalchemy import create_engine, Column, Integer, UnicodeText, Unicode, func, inspect, Index
+from sqlalchemy import create_engine, Column, Float, Integer, UnicodeText, Unicode, inspect, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+import csv_ingest
+from checkpoint import CHECKPOINT_DIR
+from csv_ingest import CsvIngester, file_profile
+from dedup_index import DedupIndex, dedup_key
+from ingest_manifest import IngestManifest
+from schema import FIELD_NAMES, column_widths, observe_widths
+from sinks import open_sink
+from watch import POLL_INTERVAL
+
 DB_HOST = '127.0.0.1'
 DB_PORT = '3306'
 DB_NAME = 'data'
 DB_USERNAME = 'admin'
 DB_PASS = 'password'
+# connections kept by the engine, one per pipeline writer and the reader
+POOL_SIZE = 5
+# MySQL drops connections idle longer than wait_timeout (8 hours by default), recycle them well before
+POOL_RECYCLE = 3600
+WORKERS = os.cpu_count() or 1
+USE_DEDUP_INDEX = False
+# one index per target, keys ingested into one database say nothing about the other
+DEDUP_INDEX_PATH = './csv_to_mysql.dedup.idx'
+LOADER = 'orm'
+EXPORT_FILES = 1
+EXPORT_ROWS = 100000
+# .csv, .csv.gz, .csv.bz2, .csv.xz or .parquet
+EXPORT_SUFFIX = '.csv'
+INGEST_MANIFEST_PATH = './csv_to_mysql.manifest.json'
+TYPED_SCHEMA = False
+# InnoDB index keys are limited to 3072 bytes, 255 utf8 chars per indexed column keeps every index within it
+MAX_INDEXED_WIDTH = 255
+# adaptive batches stay below the 4 MB max_allowed_packet default with room for one row
+MAX_BATCH_BYTES = 3 * 1024 * 1024
+MAX_BATCH_ROWS = 50000
+# writer threads flushing batches while the next ones are parsed, 0 parses and writes in turn
+PIPELINE_WRITERS = 0
+# processes parsing memory-mapped chunks of one file, 0 parses it line by line in this process
+PARSE_WORKERS = 0
+# per file run metrics, .json or a Prometheus textfile (.prom), {file} is the input file name
+METRICS_PATH = None
+# 'cprofile' or 'tracemalloc' for the input file named PROFILE_FILE, the report is written next to it
+PROFILE = None
+PROFILE_FILE = None
 
 logger = logging.getLogger(__name__)
 
@@ -46,18 +88,53 @@ def setup_logger():
 DeclarativeBase = declarative_base()
 
 
-def db_connect():
+def db_connect(local_infile=False, pool_size=POOL_SIZE):
     """Performs database connection using database settings from settings.py.
     Returns sqlalchemy engine instance.
     """
     connection_str = 'mysql+mysqldb://{}:{}@{}:{}/{}?charset=utf8&use_unicode=1'.format(DB_USERNAME, DB_PASS, DB_HOST,
                                                                                         DB_PORT, DB_NAME)
-    return create_engine(connection_str)
-
-
-def create_tables(engine):
-    """"""
-    DeclarativeBase.metadata.create_all(engine)
+    connect_args = {'local_infile': 1} if local_infile else {}
+    # pre ping replaces connections the server closed while a long running process was idle
+    return create_engine(connection_str, connect_args=connect_args, pool_size=pool_size, max_overflow=pool_size,
+                         pool_recycle=POOL_RECYCLE, pool_pre_ping=True)
+
+
+def pool_capacity(engine):
+    """Returns the number of connections the engine hands out at once, None when its pool is unbounded."""
+    size = getattr(engine.pool, 'size', None)
+    overflow = getattr(engine.pool, '_max_overflow', -1)
+    if size is None or overflow < 0:
+        return None
+    return size() + overflow
+
+
+def create_tables(engine, model=None):
+    """Creates the table of the given model, or all tables."""
+    if model is not None:
+        model.__table__.create(engine, checkfirst=True)
+        add_missing_columns(engine, model)
+    else:
+        DeclarativeBase.metadata.create_all(engine)
+
+
+def add_missing_columns(engine, model):
+    """Adds the columns of the model which a table created by an older version lacks, with their indexes."""
+    table = model.__table__
+    existing = {column['name'] for column in inspect(engine).get_columns(table.name)}
+    missing = [column for column in table.columns if column.name not in existing]
+    if not missing:
+        return
+
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as connection:
+        for column in missing:
+            logger.info('Adding column {} to {}.'.format(column.name, table.name))
+            connection.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                quote(table.name), quote(column.name), column.type.compile(engine.dialect))))
+        for index in table.indexes:
+            if any(column in missing for column in index.columns):
+                index.create(connection)
 
 
 def to_dict(obj, with_relationships=True):
@@ -130,203 +207,533 @@ class Model(DeclarativeBase):
     site_title = Column(UnicodeText)
     site_description = Column(UnicodeText)
     site_keywords = Column(UnicodeText)
+    # input file of the row, a modified file replaces its rows
+    file = Column(Unicode(255), index=True)
 
 # Index('business_unique', Model.Name, Model.full_address, unique=True)
 
-class CsvToDbConverter:
+class TypedModel(DeclarativeBase):
+    """Sqlalchemy deals model with numeric coordinates, rating and reviews.
+    The text widths below are defaults, `size_typed_columns` bounds them from observed data before the table is
+    created, only long free text stays TEXT. Values longer than their column are stored as NULL and counted.
+    """
+    __tablename__ = "csv_data_typed"
+    __table_args__ = (
+        Index('ix_csv_data_typed_rating', 'rating'),
+        Index('ix_csv_data_typed_location', 'latitude', 'longitude'),
+        Index('ix_csv_data_typed_city', 'country', 'city'),
+        Index('ix_csv_data_typed_postal_code', 'postal_code'),
+        {
+            'mysql_charset': 'utf8',
+        })
+
+    id = Column(Integer, primary_key=True)
+    Name = Column(Unicode(300))
+    Website = Column(Unicode(1000))
+    Type = Column(Unicode(255))
+    subtypes = Column(Unicode(1000))
+    Phone = Column(Unicode(50))
+    full_address = Column(Unicode(512))
+    borough = Column(Unicode(255))
+    street = Column(Unicode(255))
+    city = Column(Unicode(100))
+    postal_code = Column(Unicode(20))
+    country = Column(Unicode(100))
+    latitude = Column(Float(precision=53))
+    longitude = Column(Float(precision=53))
+    time_zone = Column(Unicode(100))
+    plus_code = Column(Unicode(255))
+    rating = Column(Float(precision=53))
+    reviews = Column(Integer)
+    reviews_link = Column(Unicode(1000))
+    photo = Column(Unicode(1000))
+    working_hours_old_format = Column(UnicodeText)
+    price_range = Column(Unicode(255))
+    posts = Column(UnicodeText)
+    verified = Column(Unicode(255))
+    reserving_table_link = Column(Unicode(1000))
+    booking_appointment_link = Column(Unicode(1000))
+    location_link = Column(Unicode(1000))
+    email = Column(Unicode(255))
+    email2 = Column(Unicode(255))
+    twitter = Column(Unicode(512))
+    linkedin = Column(Unicode(512))
+    facebook = Column(Unicode(512))
+    instagram = Column(Unicode(512))
+    google_plus = Column(Unicode(512))
+    skype = Column(Unicode(255))
+    telegram = Column(Unicode(255))
+    site_generator = Column(Unicode(255))
+    site_title = Column(Unicode(1000))
+    site_description = Column(UnicodeText)
+    site_keywords = Column(UnicodeText)
+    file = Column(Unicode(255), index=True)
+
+
+def size_typed_columns(engine, input_files):
+    """Sizes the bounded text columns of TypedModel from the widest values in the input files,
+    unless the table exists already. Indexed columns are capped at MAX_INDEXED_WIDTH, they keep their width
+    when the values need TEXT.
+    """
+    table = TypedModel.__table__
+    if table.name in inspect(engine).get_table_names():
+        return
+
+    indexed = {column.name for index in table.indexes for column in index.columns}
+    widths = observe_widths(input_files, FIELD_NAMES)
+    for column in table.columns:
+        if type(column.type) is not Unicode or column.name not in widths:
+            continue
+        width = widths[column.name]
+        if width and column.name in indexed:
+            column.type = Unicode(min(width, MAX_INDEXED_WIDTH))
+        elif width:
+            column.type = Unicode(width)
+        elif column.name not in indexed:
+            column.type = UnicodeText()
+    logger.info('Sized {} columns from {} files.'.format(table.name, len(input_files)))
+
+
+class OrmLoader:
+    """Loads batches through ORM bulk_insert_mappings."""
+
+    def __init__(self, session, model=Model, field_names=FIELD_NAMES):
+        self.session = session
+        self.model = model
+        self.field_names = field_names
+
+    def load(self, buffer):
+        self.session.bulk_insert_mappings(self.model, [dict(zip(self.field_names, record)) for record in buffer])
+        self.session.commit()
+
+
+class CoreLoader:
+    """Loads batches with a Core insert executed as one multi-row executemany, no ORM involved.
+    The statement is compiled once, the parameter dicts are built per batch.
+    """
+
+    def __init__(self, session, model=Model, field_names=FIELD_NAMES):
+        self.session = session
+        self.statement = model.__table__.insert()
+        self.field_names = field_names
+
+    def load(self, buffer):
+        if not buffer:
+            return
+        field_names = self.field_names
+        self.session.execute(self.statement, [dict(zip(field_names, record)) for record in buffer])
+        self.session.commit()
+
+
+class LoadDataLoader:
+    """Writes batches to a temporary TSV file and loads it with LOAD DATA LOCAL INFILE.
+    The engine must be created with db_connect(local_infile=True).
+    """
+    ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'})
+
+    def __init__(self, session, model=Model, field_names=FIELD_NAMES):
+        self.session = session
+        self.table = model.__table__
+        self.columns = field_names
+
+    def load(self, buffer):
+        if not buffer:
+            return
+
+        escape = self.escape
+        fd, path = tempfile.mkstemp(suffix='.tsv')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+                for record in buffer:
+                    f.write('\t'.join(map(escape, record)))
+                    f.write('\n')
+
+            statement = "LOAD DATA LOCAL INFILE '{}' INTO TABLE {} CHARACTER SET utf8 " \
+                        "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' ({})"
+            self.session.execute(text(statement.format(path.replace('\\', '/'), self.table.name,
+                                                       ', '.join('`{}`'.format(name) for name in self.columns))))
+            self.session.commit()
+        finally:
+            os.remove(path)
+
+    @classmethod
+    def escape(cls, value):
+        if value is None:
+            return '\\N'
+        return str(value).translate(cls.ESCAPES)
+
+
+LOADERS = {
+    'orm': OrmLoader,
+    'core': CoreLoader,
+    'load_data': LoadDataLoader,
+}
+
+
+class CsvToDbConverter(CsvIngester):
+    metrics_name = 'csv_to_mysql'
     __total = Value('i', 0)
     __lock = Semaphore()
 
-    def __init__(self, input_csv=None):
+    @staticmethod
+    def init_worker(total, lock):
+        # share the parent's counter and lock with pool workers
+        CsvToDbConverter.__total = total
+        CsvToDbConverter.__lock = lock
+
+    @classmethod
+    def get_total(cls):
+        return cls.__total.value
+
+    def __init__(self, input_csv=None, dedup_index_path=None, loader=LOADER, engine=None,
+                 checkpoint_dir=CHECKPOINT_DIR, typed=TYPED_SCHEMA, writers=PIPELINE_WRITERS,
+                 max_batch_bytes=MAX_BATCH_BYTES, metrics_callbacks=None, metrics_path=METRICS_PATH, profile=None,
+                 parse_workers=PARSE_WORKERS, claims_path=None):
+        super().__init__(input_csv, checkpoint_dir, typed, writers, max_batch_bytes, MAX_BATCH_ROWS,
+                         metrics_callbacks, metrics_path, profile, parse_workers)
+        self.model = TypedModel if typed else Model
         self.session = None
-        if input_csv:
-            self.__input_csv = input_csv + '.csv' if not str(input_csv).lower().endswith('.csv') else input_csv
-        else:
-            self.__input_csv = None
+        self.engine = engine
+        self.__loader = LOADERS[loader]
+        self.__keys = None
+        self.__dedup_index_path = dedup_index_path
+        self.__claims_path = claims_path
+        self.__claims = None
 
     def __enter__(self):
         self.__init()
-        engine = db_connect()
-        engine.execution_options(stream_results=True)
-        create_tables(engine)
-        self.Session = sessionmaker(bind=engine)
+        if self.engine is None:
+            self.engine = db_connect(local_infile=self.__loader is LoadDataLoader)
+        create_tables(self.engine, self.model)
+        if self.typed:
+            self.widths = column_widths(inspect(self.engine).get_columns(self.model.__tablename__))
+        self.Session = sessionmaker(bind=self.engine)
+
+        if self.__dedup_index_path:
+            self.__keys = DedupIndex(self.__dedup_index_path)
+            self.__keys.open()
+        if self.__claims_path:
+            self.__claims = DedupIndex(self.__claims_path)
+            self.__claims.open()
+            if self.__keys is None:
+                # the run index was built from the table, it holds the stored keys as well
+                self.__keys = self.__claims
         return self
 
     def __init(self):
-        hdr = [('Name', 'Name'),
-               ('Website', 'Website'),
-               ('Type', 'Type'),
-               ('subtypes', 'subtypes'),
-               ('Phone', 'Phone'),
-               ('full_address', 'full_address'),
-               ('borough', 'borough'),
-               ('street', 'street'),
-               ('city', 'city'),
-               ('postal_code', 'postal_code'),
-               ('country', 'country'),
-               ('latitude', 'latitude'),
-               ('longitude', 'longitude'),
-               ('time_zone', 'time_zone'),
-               ('plus_code', 'plus_code'),
-               ('rating', 'rating'),
-               ('reviews', 'reviews'),
-               ('reviews_link', 'reviews_link'),
-               ('photo', 'photo'),
-               ('working_hours_old_format', 'working_hours_old_format'),
-               ('price_range', 'price_range'),
-               ('posts', 'posts'),
-               ('verified', 'verified'),
-               ('reserving_table_link', 'reserving_table_link'),
-               ('booking_appointment_link', 'booking_appointment_link'),
-               ('location_link', 'location_link'),
-               ('email', 'email'),
-               ('email2', 'email2'),
-               ('twitter', 'twitter'),
-               ('linkedin', 'linkedin'),
-               ('facebook', 'facebook'),
-               ('instagram', 'instagram'),
-               ('google_plus', 'google_plus'),
-               ('skype', 'skype'),
-               ('telegram', 'telegram'),
-               ('site_generator', 'site_generator'),
-               ('site_title', 'site_title'),
-               ('site_description', 'site_description'),
-               ('site_keywords', 'site_keywords')]
-
-        self.__csv_header = OrderedDict(hdr)
-        self.__field_names = list(self.__csv_header.keys())
+        self.__field_names = self.mapper.field_names
+        # loaded records end with the input file
+        self.__load_fields = self.__field_names + ['file']
+        # exported column order, fixed once from the schema
+        self.__columns = [self.model.__table__.c[name] for name in self.__field_names]
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.__input_csv:
-            logger.info('=== Finish processing: {} ==='.format(self.__input_csv))
+        if self.input_csv:
+            logger.info('=== Finish processing: {} ==='.format(self.input_csv))
         # else:
         #     logger.info('=== Export to csv: {} done! ==='.format(self.__output_csv))
 
         if self.session:
             self.session.close()
+        if isinstance(self.__keys, DedupIndex):
+            self.__keys.close()
+        if self.__claims is not None:
+            self.__claims.close()
         del self
 
-    def process_data(self):
-        try:
-            logger.info('=== Start processing: {} ==='.format(self.__input_csv))
+    def __add_total(self, count):
+        with self.__lock:
+            self.__total.value += count
+
+    def iter_keys(self, session):
+        """Yields the dedup key of every stored row in one streaming pass."""
+        query = session.query(self.model.Name, self.model.full_address).execution_options(stream_results=True)
+        for name, full_address in query.yield_per(10000):
+            yield dedup_key(name, full_address)
+
+    def load_keys(self, session):
+        self.__keys = set(self.iter_keys(session))
+        logger.info('Loaded {} dedup keys.'.format(len(self.__keys)))
+
+    def dedup_keys(self):
+        """Returns the keys of the stored rows, the open dedup index or a set loaded once from the table.
+        Both answer `in` and take the keys of newly stored rows with `update`.
+        """
+        if self.__keys is None:
             session = self.Session()
-            if os.path.exists(self.__input_csv):
-                with open(self.__input_csv, 'r', errors='ignore') as f:
-                    reader = csv.reader(f, quoting=csv.QUOTE_ALL)
-                    index = 0
-                    buffer = []
-                    for row in reader:
-                        try:
-                            if index == 0 or not row:
-                                continue
-
-                            if len(row) < 13:
-                                logger.warning('There are less than 13 columns!')
-                                continue
-
-                            # old code
-                            # Create a zip object from two lists
-                            zip_data = zip(self.__field_names, row)
-                            # Create a dictionary from zip object
-                            data_dict = dict(zip_data)
-
-                            # db operation
-                            # model = Model(**data_dict)
-                            # session.add(model)
-                            # session.commit()
-                            # end old code
-
-                            # new code
-                            buffer.append(data_dict)
-
-                            if any([b for b in buffer if data_dict['Name'].lower() == b['Name'] and
-                                                       data_dict['full_address'] == b['full_address']]):
-                                logger.warning('item already exists!')
-                                continue
-
-                            query = {'Name': data_dict['Name'], 'full_address': data_dict['full_address']}
-                            q_data = session.query(Model).filter_by(**query).first()
-                            if q_data:
-                                logger.warning('item inside database!')
-                                continue
-
-                            if len(buffer) % 1000 == 0:
-                                session.bulk_insert_mappings(Model, buffer)
-                                session.commit()
-                                buffer = []
-
-                            # row_data = ','.join([r.strip() for r in row if r])
-                            # data_hash = hashlib.md5(row_data.encode('utf-8')).hexdigest()
-                            # query = {'data_hash': data_hash}
-                            # q_data = session.query(Model).filter_by(**query).first()
-                            # if not q_data:
-                            #     # Create a zip object from two lists
-                            #     zip_data = zip(self.__field_names, row)
-                            #     # Create a dictionary from zip object
-                            #     data_dict = dict(zip_data)
-                            #     data_dict['data_hash'] = data_hash
-                            #
-                            #     # db operation
-                            #     model = Model(**data_dict)
-                            #     session.add(model)
-                            #     session.commit()
-                            # else:
-                            #     logger.warning('Data: {} already exists!'.format(data_hash))
-                        except Exception as ex:
-                            logger.error('Error processing each row: {}'.format(ex))
-                        finally:
-                            index += 1
-
-                    session.bulk_insert_mappings(Model, buffer)
-                    session.commit()
-        except Exception as x:
-            logger.error('Error when process data: {}'.format(x))
-            if session:
-                session.rollback()
-        finally:
-            if session:
+            try:
+                self.load_keys(session)
+            finally:
                 session.close()
+        return self.__keys
 
-    def export_to_csv(self, i=0, output_dir='./output_csv'):
+    def rebuild_dedup_index(self, path=DEDUP_INDEX_PATH):
+        """Rebuilds the persistent dedup index from the rows stored in the table."""
+        session = self.Session()
+        try:
+            if isinstance(self.__keys, DedupIndex) and os.path.abspath(self.__keys.path) == os.path.abspath(path):
+                # the open index is rebuilt in place and reopened
+                self.__keys.rebuild(self.iter_keys(session))
+                return
+            with DedupIndex(path) as index:
+                index.rebuild(self.iter_keys(session))
+        finally:
+            session.close()
+
+    def open_writer(self):
+        """Opens a session and loader of its own, returns the (load, close) pair of a pipeline writer.
+        Records are the csv fields followed by the input file.
+        """
+        session = self.Session()
+        loader = self.__loader(session, self.model, self.__load_fields)
+
+        def load(buffer):
+            loader.load(buffer)
+            self.__add_total(len(buffer))
+        return load, session.close
+
+    def claim(self, keys):
+        """Claims the keys of a batch in the run index the workers share, returns those another worker took first."""
+        if self.__claims is None:
+            return set()
+        return self.__claims.claim(keys)
+
+    def row_overhead(self):
+        # quotes, separators and escaping per value, and the input file every row ends with
+        return 4 * (len(FIELD_NAMES) + 1) + len(self.input_csv.encode('utf-8'))
+
+    def to_item(self, record, hash):
+        record.append(self.input_csv)
+        return record
+
+    def remove_file(self, file):
+        """Deletes every row ingested from the file through the file index, so a modified file replaces its rows.
+        Their keys leave the key cache, a persistent dedup index has to be rebuilt afterwards.
+        """
+        session = self.Session()
+        try:
+            rows = session.query(self.model).filter(self.model.file == file)
+            if isinstance(self.__keys, set):
+                query = rows.with_entities(self.model.Name, self.model.full_address)
+                self.__keys.difference_update(dedup_key(name, full_address)
+                                              for name, full_address in query.yield_per(10000))
+            deleted = rows.delete(synchronize_session=False)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        logger.info('Removed {} rows of: {}'.format(deleted, file))
+        return deleted
+
+    def export_to_csv(self, i=0, output_dir='./output_csv', rows=EXPORT_ROWS, batch_size=10000,
+                      suffix=EXPORT_SUFFIX, max_rows=None, max_bytes=None):
         try:
             if not os.path.exists(output_dir):
                 os.mkdir(output_dir)
-            output_csv = datetime.datetime.now().strftime('{}/{}_output.csv'.format(output_dir, i))
+            output_csv = datetime.datetime.now().strftime('{}/{}_output{}'.format(output_dir, i, suffix))
 
             logger.info('Write start for: {}'.format(output_csv))
-            with open(output_csv, mode='w+', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=self.__field_names, quoting=csv.QUOTE_ALL)
-                writer.writerow(self.__csv_header)
-                # session = self.Session()
-                # records = session.query(Model).order_by(func.rand()).limit(100000).all()
+            with open_sink(output_csv, self.__field_names, max_rows=max_rows, max_bytes=max_bytes) as writer:
+                records = self.get_results()
                 index = 0
-                for record in self.get_results():
-                    item = to_dict(record)
-                    del item['id']
-
-                    writer.writerow(item)
-                    del record
-                    del item
-                    index += 1
-
-                    if index % 100000 == 0:
+                while index < rows:
+                    batch = list(islice(records, min(batch_size, rows - index)))
+                    if not batch:
                         break
+                    writer.writerows(batch)
+                    index += len(batch)
         except Exception as x:
             logger.error('Error when export to csv from database.Error details: {}'.format(x))
         finally:
             logger.info('Write finish for: {}'.format(output_csv))
-        #     if session:
-        #         session.close()
 
-    def query_db(self):
+    def split_ranges(self, rows_per_file):
+        """Splits the table into id ranges of `rows_per_file` rows each.
+        Returns (start, end) pairs, start exclusive and end inclusive, None means unbounded.
+        Each boundary is found with OFFSET from the previous one, which walks `rows_per_file` primary key entries,
+        so finding all boundaries scans the whole primary key once.
+        """
+        session = self.Session()
+        try:
+            ranges = []
+            start = None
+            while True:
+                query = session.query(self.model.id).order_by(self.model.id)
+                if start is not None:
+                    query = query.filter(self.model.id > start)
+                end = query.offset(rows_per_file - 1).limit(1).scalar()
+                if end is None:
+                    break
+                ranges.append((start, end))
+                start = end
+
+            # the tail holds fewer rows, or is empty when the table splits evenly
+            query = session.query(self.model.id)
+            if start is not None:
+                query = query.filter(self.model.id > start)
+            if query.first():
+                ranges.append((start, None))
+            return ranges
+        finally:
+            session.close()
+
+    def export_partitioned(self, rows_per_file=EXPORT_ROWS, workers=WORKERS, output_dir='./output_csv',
+                           suffix=EXPORT_SUFFIX):
+        """Exports the table into files of `rows_per_file` rows split by id ranges.
+        Files are written concurrently, each writer with its own connection, so there are at most as many
+        writers as the engine's pool has connections.
+        A manifest.json with every file and its row count is written next to them, partitions which failed
+        are listed under `failed` and can be exported again by their id range.
+        """
+        if not os.path.exists(output_dir):
+            os.mkdir(output_dir)
+
+        capacity = pool_capacity(self.engine)
+        if capacity and workers > capacity:
+            # more writers would wait on the pool and time out
+            logger.info('Exporting with {} writers, the connection pool limit.'.format(capacity))
+            workers = capacity
+
+        ranges = self.split_ranges(rows_per_file)
+        logger.info('Exporting {} partitions of {} rows.'.format(len(ranges), rows_per_file))
+        tasks = [('{}/{}_output{}'.format(output_dir, i + 1, suffix), start, end)
+                 for i, (start, end) in enumerate(ranges)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            rows = list(executor.map(lambda task: self.__export_range(*task), tasks))
+
+        written = [(task, count) for task, count in zip(tasks, rows) if count is not None]
+        manifest = {
+            'rows_per_file': rows_per_file,
+            'total_rows': sum(count for _, count in written),
+            'files': [{'file': os.path.basename(path), 'rows': count, 'start_id': start, 'end_id': end}
+                      for (path, start, end), count in written],
+            'failed': [{'file': os.path.basename(path), 'start_id': start, 'end_id': end}
+                       for (path, start, end), count in zip(tasks, rows) if count is None],
+        }
+        with open(os.path.join(output_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        logger.info('Exported {} rows into {} files ({} failed).'.format(
+            manifest['total_rows'], len(written), len(manifest['failed'])))
+        return manifest
+
+    def __export_range(self, output_csv, start, end):
+        """Writes one partition, returns its row count or None when it failed."""
+        logger.info('Write start for: {}'.format(output_csv))
+        index = 0
+        try:
+            with open_sink(output_csv, self.__field_names) as writer:
+                for rows in self.stream_rows(start=start, end=end):
+                    writer.writerows(rows)
+                    index += len(rows)
+        except Exception as x:
+            logger.error('Error when export partition: {}. Details: {}'.format(output_csv, x))
+            if os.path.exists(output_csv):
+                os.remove(output_csv)
+            return None
+        logger.info('Write finish for: {} ({} rows)'.format(output_csv, index))
+        return index
+
+    def query_db(self, sample_size=None, seed=None):
         try:
-            self.session = self.Session()
-            self.records = self.session.query(Model).order_by(func.rand()).yield_per(10000)
-            # for record in records:
-            #     yield record
+            # ORDER BY RAND() sorts the whole table before returning a row, sample by primary key instead
+            if sample_size:
+                self.records = self.sample(size=sample_size, seed=seed)
+            else:
+                self.records = chain.from_iterable(self.stream_rows())
         except Exception as x:
             logger.error(x)
 
+    def stream_rows(self, start=None, end=None, ids=None, batch_size=10000):
+        """Yields batches of plain value tuples in csv column order, read through a server-side cursor.
+        No ORM objects are built. `start` (exclusive), `end` (inclusive) and `ids` restrict the rows.
+        """
+        session = self.Session()
+        try:
+            query = session.query(*self.__columns).order_by(self.model.id)
+            if start is not None:
+                query = query.filter(self.model.id > start)
+            if end is not None:
+                query = query.filter(self.model.id <= end)
+            if ids is not None:
+                query = query.filter(self.model.id.in_(ids))
+            statement = query.statement
+        finally:
+            session.close()
+
+        with self.engine.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(statement)
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+
+    def keyset_scan(self, *entities, batch_size=10000, start=None, end=None):
+        """Yields rows in id order with keyset pagination (id > last id), without OFFSET or sorting.
+        Yields model objects by default, or values of the given columns.
+        `start` (exclusive) and `end` (inclusive) restrict the scan to an id range.
+        """
+        entities = entities or (self.model,)
+        session = self.Session()
+        try:
+            last_id = start
+            while True:
+                query = session.query(self.model.id, *entities).order_by(self.model.id)
+                if last_id is not None:
+                    query = query.filter(self.model.id > last_id)
+                if end is not None:
+                    query = query.filter(self.model.id <= end)
+                rows = query.limit(batch_size).all()
+                if not rows:
+                    break
+
+                for row in rows:
+                    yield row[1] if len(entities) == 1 else tuple(row[1:])
+                last_id = rows[-1][0]
+                session.expunge_all()
+        finally:
+            session.close()
+
+    def sample(self, size=None, fraction=None, seed=None, batch_size=10000):
+        """Yields a uniform random sample of rows in id order, as value tuples in csv column order.
+        With `size` exactly that many rows are picked by reservoir sampling, with `fraction` every row is
+        picked with that probability. Picking scans only the primary key, picked rows are fetched by id.
+        """
+        if (size is None) == (fraction is None):
+            raise ValueError('Specify either sample size or fraction.')
+
+        rnd = random.Random(seed)
+        ids = self.keyset_scan(self.model.id, batch_size=batch_size)
+        if size is not None:
+            reservoir = []
+            for i, id in enumerate(ids):
+                if i < size:
+                    reservoir.append(id)
+                else:
+                    j = rnd.randrange(i + 1)
+                    if j < size:
+                        reservoir[j] = id
+            reservoir.sort()
+            for i in range(0, len(reservoir), batch_size):
+                yield from self.__fetch(reservoir[i:i + batch_size])
+        else:
+            picked = []
+            for id in ids:
+                if rnd.random() < fraction:
+                    picked.append(id)
+                    if len(picked) >= batch_size:
+                        yield from self.__fetch(picked)
+                        picked = []
+            yield from self.__fetch(picked)
+
+    def __fetch(self, ids):
+        if not ids:
+            return
+        for rows in self.stream_rows(ids=ids, batch_size=len(ids)):
+            yield from rows
+
     def get_results(self):
         try:
             for record in self.records:
@@ -335,9 +742,45 @@ class CsvToDbConverter:
             logger.error(x)
 
 
+def process_files(input_files, workers=WORKERS, dedup_index_path=None):
+    """Ingests each file in its own worker process.
+    The workers share one run index. It is built from the table once, unless the persistent dedup index holds
+    the stored keys, and every batch claims its keys there before it is written, so a row found in several
+    files ingested at the same time is stored once.
+    A failing file is logged and skipped, the rest of the batch continues.
+    Returns the list of files which failed.
+    """
+    claims_dir = tempfile.mkdtemp(prefix='csv_to_mysql_')
+    claims_path = os.path.join(claims_dir, 'claims.idx')
+    try:
+        # the table is created once here, workers creating it at the same time fail with "table already exists"
+        with CsvToDbConverter() as converter:
+            if not dedup_index_path:
+                converter.rebuild_dedup_index(claims_path)
+
+        return csv_ingest.process_files(CsvToDbConverter, input_files, workers, PROFILE, PROFILE_FILE,
+                                        dedup_index_path=dedup_index_path, claims_path=claims_path)
+    finally:
+        shutil.rmtree(claims_dir, ignore_errors=True)
+
+
+def watch_files(input_directory, dedup_index_path=None, manifest_path=INGEST_MANIFEST_PATH,
+                poll_interval=POLL_INTERVAL, engine=None):
+    """Daemon mode, ingests csv files as they land in the input directory until SIGINT or SIGTERM.
+    One converter keeps the engine, the created tables and the dedup keys for every file.
+    """
+    with CsvToDbConverter(dedup_index_path=dedup_index_path, engine=engine) as converter:
+        converter.watch(input_directory, manifest_path, dedup_index_path, poll_interval, PROFILE, PROFILE_FILE)
+
+    if dedup_index_path:
+        with DedupIndex(dedup_index_path) as index:
+            index.compact()
+
+
 if __name__ == '__main__':
     setup_logger()
-    mode = int(input('Please specify Mode (1 for db insert, 2 for csv export!): '))
+    csv_ingest.setup_logger()
+    mode = int(input('Please specify Mode (1 for db insert, 2 for csv export, 3 for partitioned csv export!): '))
 
     input_directory = './csv_data'  # input('Please specify Input csv: ')
     # for input_file in glob.glob('{}/*.csv'.format(input_directory)):
@@ -346,12 +789,45 @@ if __name__ == '__main__':
     #         converter.process_data()
 
     if mode == 1:
-        for input_file in glob.glob('{}/*.csv'.format(input_directory)):
-            logger.info('Processing CSV: {}'.format(input_file))
-            with CsvToDbConverter(input_file) as converter:
-                converter.process_data()
+        input_files = glob.glob('{}/*.csv'.format(input_directory))
+
+        # skip files ingested by an earlier run, replace the rows of modified ones
+        manifest = IngestManifest(INGEST_MANIFEST_PATH)
+        new_files, modified_files = manifest.changed(input_files)
+        input_files = new_files + modified_files
+
+        if TYPED_SCHEMA:
+            # bounded columns fit the widest values of these files when this run creates the table
+            engine = db_connect()
+            size_typed_columns(engine, input_files)
+            engine.dispose()
+
+        dedup_index_path = DEDUP_INDEX_PATH if USE_DEDUP_INDEX else None
+        with CsvToDbConverter() as converter:
+            converter.replace_files(modified_files, dedup_index_path)
+
+        if WORKERS > 1:
+            failed = process_files(input_files, WORKERS, dedup_index_path)
+        else:
+            # one converter, so the keys of the table are loaded once for all files
+            with CsvToDbConverter(dedup_index_path=dedup_index_path) as converter:
+                failed = [input_file for input_file in input_files
+                          if not converter.ingest(input_file, file_profile(input_file, PROFILE, PROFILE_FILE))]
+
+        for input_file in input_files:
+            if input_file not in failed:
+                manifest.record(input_file)
+        manifest.save()
+
+        if dedup_index_path:
+            with DedupIndex(dedup_index_path) as index:
+                index.compact()
     elif mode == 2:
         with CsvToDbConverter() as converter:
-            converter.query_db()
-            for i in range(1):
+            converter.query_db(sample_size=EXPORT_ROWS * EXPORT_FILES)
+            for i in range(EXPORT_FILES):
                 converter.export_to_csv(i + 1)
+    elif mode == 3:
+        # a connection per export writer
+        with CsvToDbConverter(engine=db_connect(pool_size=WORKERS)) as converter:
+            converter.export_partitioned(EXPORT_ROWS, WORKERS)
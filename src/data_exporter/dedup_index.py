@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+import bisect
+import hashlib
+import heapq
+import logging
+import mmap
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+DEDUP_INDEX_PATH = './dedup.idx'
+DEDUP_KEY_SIZE = 16
+RUN_SIZE = 5000000
+
+
+def make_hash(name, full_address):
+    """Builds the normalized dedup string, same as the `hash` field stored by csv_to_mongodb."""
+    return (name or '').lower().strip() + (full_address or '').lower().strip()
+
+
+def digest(value):
+    """Returns a compact fixed-size digest of a dedup string."""
+    return hashlib.blake2b(value.encode('utf-8'), digest_size=DEDUP_KEY_SIZE).digest()
+
+
+def dedup_key(name, full_address):
+    return digest(make_hash(name, full_address))
+
+
+class _SortedKeys:
+    """Read-only sequence view over a memory-mapped file of sorted fixed-size keys."""
+
+    def __init__(self, buf):
+        self.buf = buf
+
+    def __len__(self):
+        return len(self.buf) // DEDUP_KEY_SIZE
+
+    def __getitem__(self, i):
+        offset = i * DEDUP_KEY_SIZE
+        return self.buf[offset:offset + DEDUP_KEY_SIZE]
+
+
+class DedupIndex:
+    """Persistent key index shared across runs, files and worker processes.
+
+    Keys live in a sorted digest file which is memory-mapped and binary searched,
+    keys added since the last compaction are appended to a journal next to it.
+    Journal records written by other processes are picked up on lookup misses.
+    """
+
+    def __init__(self, path=DEDUP_INDEX_PATH):
+        self.path = path
+        self.journal_path = path + '.log'
+        self.__mm = None
+        self.__sorted = _SortedKeys(b'')
+        self.__recent = set()
+        self.__journal = None
+        self.__journal_offset = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.__sorted) + len(self.__recent)
+
+    def __contains__(self, key):
+        if key in self.__recent or self.__search(key):
+            return True
+
+        # another process may have added it meanwhile
+        self.__read_journal()
+        return key in self.__recent
+
+    def open(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, 'rb') as f:
+                self.__mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__sorted = _SortedKeys(self.__mm)
+
+        self.__journal = open(self.journal_path, 'ab+')
+        self.__read_journal()
+        logger.info('Dedup index: {} keys loaded from {}.'.format(len(self), self.path))
+
+    def close(self):
+        if self.__journal:
+            self.__journal.close()
+            self.__journal = None
+        if self.__mm:
+            self.__mm.close()
+            self.__mm = None
+        self.__sorted = _SortedKeys(b'')
+        self.__recent = set()
+        self.__journal_offset = 0
+
+    def update(self, keys):
+        """Adds keys to the index, they are visible to other processes at once."""
+        keys = [key for key in keys if key not in self.__recent]
+        if not keys:
+            return
+
+        # a single O_APPEND write, so records from concurrent processes never interleave
+        self.__journal.write(b''.join(keys))
+        self.__journal.flush()
+        self.__recent.update(keys)
+
+    def claim(self, keys):
+        """Adds the keys which are not in the index yet and returns the set of keys which already were.
+        When processes claim the same key at once each appends it, the first record in the journal wins.
+        """
+        self.__read_journal()
+        taken = {key for key in keys if key in self.__recent or self.__search(key)}
+        claimed = [key for key in dict.fromkeys(keys) if key not in taken]
+        if not claimed:
+            return taken
+
+        data = b''.join(claimed)
+        self.__journal.write(data)
+        self.__journal.flush()
+        # records other processes appended between the read above and this O_APPEND write
+        fd = self.__journal.fileno()
+        start = os.lseek(fd, 0, os.SEEK_CUR) - len(data)
+        data = os.pread(fd, start - self.__journal_offset, self.__journal_offset)
+        earlier = {data[i:i + DEDUP_KEY_SIZE] for i in range(0, len(data), DEDUP_KEY_SIZE)}
+        taken.update(key for key in claimed if key in earlier)
+        self.__read_journal()
+        return taken
+
+    def compact(self):
+        """Merges the journal into the sorted key file and truncates the journal."""
+        self.__read_journal()
+        recent = sorted(self.__recent.difference(self.__sorted_iter()))
+        self.__write_sorted(heapq.merge(self.__sorted_iter(), recent))
+        logger.info('Dedup index: compacted {} keys.'.format(len(self)))
+
+    def rebuild(self, keys):
+        """Replaces the whole index with the given keys.
+        Keys are sorted in bounded runs spilled to disk, then merged, so memory stays bounded.
+        """
+        runs = []
+        try:
+            run = set()
+            for key in keys:
+                run.add(key)
+                if len(run) >= RUN_SIZE:
+                    runs.append(self.__spill(run))
+                    run = set()
+            if run:
+                runs.append(self.__spill(run))
+
+            self.__write_sorted(self.__dedup_sorted(heapq.merge(*[self.__run_iter(run) for run in runs])))
+        finally:
+            for run in runs:
+                run.close()
+        logger.info('Dedup index: rebuilt with {} keys.'.format(len(self)))
+
+    def __search(self, key):
+        i = bisect.bisect_left(self.__sorted, key)
+        return i < len(self.__sorted) and self.__sorted[i] == key
+
+    def __sorted_iter(self):
+        for i in range(len(self.__sorted)):
+            yield self.__sorted[i]
+
+    def __read_journal(self):
+        size = os.fstat(self.__journal.fileno()).st_size
+        size -= size % DEDUP_KEY_SIZE
+        if size <= self.__journal_offset:
+            return
+
+        self.__journal.seek(self.__journal_offset)
+        data = self.__journal.read(size - self.__journal_offset)
+        self.__journal_offset = size
+        self.__recent.update(data[i:i + DEDUP_KEY_SIZE] for i in range(0, len(data), DEDUP_KEY_SIZE))
+
+    def __write_sorted(self, keys):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            for key in keys:
+                f.write(key)
+        os.replace(tmp_path, self.path)
+
+        self.close()
+        with open(self.journal_path, 'wb'):
+            pass
+        self.open()
+
+    @staticmethod
+    def __spill(run):
+        f = tempfile.TemporaryFile()
+        f.write(b''.join(sorted(run)))
+        f.seek(0)
+        return f
+
+    @staticmethod
+    def __run_iter(f):
+        while True:
+            key = f.read(DEDUP_KEY_SIZE)
+            if not key:
+                break
+            yield key
+
+    @staticmethod
+    def __dedup_sorted(keys):
+        last = None
+        for key in keys:
+            if key != last:
+                yield key
+                last = key
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1024 * 1024
+
+
+def fingerprint(path, block_size=BLOCK_SIZE):
+    """Content fingerprint, a hash of the whole file read in blocks of `block_size` bytes."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class IngestManifest:
+    """Records the input files already ingested with their size, mtime and content fingerprint.
+    Unchanged files are recognized from a stat call, the fingerprint is only computed when the mtime differs
+    at the same size, to tell a touched file from one edited in place.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.files = json.load(f)
+
+    def status(self, input_csv):
+        """Returns 'new', 'modified' or 'unchanged'."""
+        entry = self.files.get(os.path.abspath(input_csv))
+        if not entry:
+            return 'new'
+
+        stat = os.stat(input_csv)
+        if entry['size'] != stat.st_size:
+            return 'modified'
+        if entry['mtime'] == stat.st_mtime:
+            return 'unchanged'
+
+        if entry['fingerprint'] == fingerprint(input_csv):
+            # only touched, keep the new mtime so the next check is a stat again
+            entry['mtime'] = stat.st_mtime
+            return 'unchanged'
+        return 'modified'
+
+    def changed(self, input_files):
+        """Splits input files into (new, modified), unchanged files are left out."""
+        new, modified = [], []
+        for input_csv in input_files:
+            status = self.status(input_csv)
+            if status == 'new':
+                new.append(input_csv)
+            elif status == 'modified':
+                modified.append(input_csv)
+        logger.info('Input files: {} new, {} modified, {} unchanged.'.format(
+            len(new), len(modified), len(input_files) - len(new) - len(modified)))
+        return new, modified
+
+    def record(self, input_csv):
+        stat = os.stat(input_csv)
+        self.files[os.path.abspath(input_csv)] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'fingerprint': fingerprint(input_csv),
+        }
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.files, f, indent=2)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds of the flush latency histogram, Prometheus style
+FLUSH_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_TOP = 30
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # kilobytes on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+class Laps:
+    """Splits the time of a loop into stages, each `lap` books the time since the previous one.
+    One clock read per stage boundary, cheap enough to run on every row.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.mark = time.perf_counter()
+
+    def lap(self, stage):
+        """Books and returns the seconds since the previous lap."""
+        now = time.perf_counter()
+        seconds = now - self.mark
+        self.stages[stage] += seconds
+        self.mark = now
+        return seconds
+
+
+class Metrics:
+    """Counters, time per stage and a flush latency histogram of one run.
+
+    Callbacks are called as `callback(event, snapshot)` with event 'flush' after every stored batch
+    and 'finish' at the end. `write` stores the final snapshot as JSON, or as a Prometheus textfile
+    when the path ends with .prom.
+    """
+
+    def __init__(self, job, labels=None, callbacks=None):
+        self.job = job
+        self.labels = labels or {}
+        self.callbacks = list(callbacks or [])
+        self.counters = Counter()
+        self.stages = Counter()
+        self.sections = {}
+        self.buckets = [0] * (len(FLUSH_BUCKETS) + 1)
+        self.flush_sum = 0.0
+        self.flush_count = 0
+        self.start = time.time()
+        self.elapsed = None
+
+    def laps(self):
+        return Laps(self.stages)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - start
+
+    def incr(self, name, n=1):
+        self.counters[name] += n
+
+    def add_section(self, name, values):
+        """Attaches a dict of extra values, e.g. pipeline or batch statistics."""
+        self.sections[name] = values
+
+    def observe_flush(self, seconds, rows=0, nbytes=0):
+        i = 0
+        while i < len(FLUSH_BUCKETS) and seconds > FLUSH_BUCKETS[i]:
+            i += 1
+        self.buckets[i] += 1
+        self.flush_sum += seconds
+        self.flush_count += 1
+        self.counters['rows_written'] += rows
+        self.counters['bytes_written'] += nbytes
+        if self.callbacks:
+            self.emit('flush')
+
+    def snapshot(self):
+        elapsed = self.elapsed if self.elapsed is not None else time.time() - self.start
+        cumulative = []
+        total = 0
+        for count in self.buckets:
+            total += count
+            cumulative.append(total)
+        return {
+            'job': self.job,
+            'labels': self.labels,
+            'elapsed': elapsed,
+            'counters': dict(self.counters),
+            'rows_per_sec': self.counters['rows_read'] / elapsed if elapsed else 0,
+            'stages': dict(self.stages),
+            'flush_seconds': {
+                'buckets': dict(zip([str(bound) for bound in FLUSH_BUCKETS] + ['+Inf'], cumulative)),
+                'sum': self.flush_sum,
+                'count': self.flush_count,
+            },
+            'peak_rss_mb': peak_rss_mb(),
+            'sections': self.sections,
+        }
+
+    def emit(self, event):
+        snapshot = self.snapshot()
+        for callback in self.callbacks:
+            try:
+                callback(event, snapshot)
+            except Exception as x:
+                logger.error('Error in metrics callback: {}'.format(x))
+        return snapshot
+
+    def finish(self, path=None):
+        """Ends the run, calls the callbacks and writes the snapshot when a path is given."""
+        self.elapsed = time.time() - self.start
+        snapshot = self.emit('finish')
+        stages = ', '.join('{} {:.2f}s'.format(stage, seconds) for stage, seconds in self.stages.most_common())
+        logger.info('{}: {} rows in {:.2f}s ({:.0f} rows/s){}.'.format(
+            self.job, self.counters['rows_read'], self.elapsed, snapshot['rows_per_sec'],
+            ', ' + stages if stages else ''))
+        if path:
+            self.write(path, snapshot)
+        return snapshot
+
+    def write(self, path, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            if str(path).lower().endswith('.prom'):
+                f.write(self.prometheus(snapshot))
+            else:
+                json.dump(snapshot, f, indent=2)
+        # the textfile collector must never see a half written file
+        os.replace(tmp_path, path)
+
+    def prometheus(self, snapshot):
+        labels = dict(self.labels, job=self.job)
+
+        def series(name, extra=None):
+            values = dict(labels, **(extra or {}))
+            return 'data_exporter_{}{{{}}}'.format(name, ','.join(
+                '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                for key, value in sorted(values.items())))
+
+        lines = ['# TYPE data_exporter_elapsed_seconds gauge',
+                 '{} {}'.format(series('elapsed_seconds'), snapshot['elapsed']),
+                 '# TYPE data_exporter_rows_per_second gauge',
+                 '{} {}'.format(series('rows_per_second'), snapshot['rows_per_sec'])]
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE data_exporter_{}_total counter'.format(name))
+            lines.append('{} {}'.format(series(name + '_total'), value))
+
+        lines.append('# TYPE data_exporter_stage_seconds_total counter')
+        for stage, seconds in sorted(snapshot['stages'].items()):
+            lines.append('{} {}'.format(series('stage_seconds_total', {'stage': stage}), seconds))
+
+        lines.append('# TYPE data_exporter_flush_seconds histogram')
+        for bound, count in snapshot['flush_seconds']['buckets'].items():
+            lines.append('{} {}'.format(series('flush_seconds_bucket', {'le': bound}), count))
+        lines.append('{} {}'.format(series('flush_seconds_sum'), snapshot['flush_seconds']['sum']))
+        lines.append('{} {}'.format(series('flush_seconds_count'), snapshot['flush_seconds']['count']))
+
+        if snapshot['peak_rss_mb'] is not None:
+            lines.append('# TYPE data_exporter_peak_rss_bytes gauge')
+            lines.append('{} {}'.format(series('peak_rss_bytes'), int(snapshot['peak_rss_mb'] * 1024 * 1024)))
+        return '\n'.join(lines) + '\n'
+
+
+def metrics_path(template, input_file):
+    """Fills the {file} placeholder of a metrics path with the input file name."""
+    if not template:
+        return None
+    return template.format(file=os.path.splitext(os.path.basename(input_file or 'run'))[0])
+
+
+@contextmanager
+def profiled(kind, path):
+    """Runs the block under cProfile or tracemalloc and writes the report next to `path`.
+    cProfile only sees the calling thread, pipeline writer threads are not included.
+    """
+    if kind == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path + '.prof')
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP)
+            logger.info('Profile written to: {}.prof\n{}'.format(path, out.getvalue()))
+    elif kind == 'tracemalloc':
+        tracemalloc.start(25)
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(path + '.tracemalloc.txt', 'w', encoding='utf-8') as f:
+                f.write('current: {} bytes, peak: {} bytes\n'.format(current, peak))
+                for stat in snapshot.statistics('lineno')[:PROFILE_TOP]:
+                    f.write('{}\n'.format(stat))
+            logger.info('Allocation peak {:.1f} MB, top allocations written to: {}.tracemalloc.txt'.format(
+                peak / 1024 / 1024, path))
+    else:
+        yield
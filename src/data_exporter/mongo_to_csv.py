@@ -1,17 +1,39 @@
 # -*- coding: utf-8 -*-
+import datetime
+import json
 import logging
-from collections import OrderedDict
+import os
+import shutil
 from logging.handlers import RotatingFileHandler
+from multiprocessing import Pool
 
+from bson import ObjectId
 from pymongo import MongoClient
 import csv
 import time
 
+from checkpoint import CHECKPOINT_DIR, Watermark
+from metrics import Metrics, metrics_path
+from schema import CSV_HEADER, FIELD_NAMES, RowMapper
+from sinks import open_sink, open_text, normalize_output, split_suffix
+
 logger = logging.getLogger(__name__)
 
 MONGO_URI = 'mongodb://localhost:27017'
 MONGO_DATABASE = 'data'
 MONGO_COLLECTION_NAME = 'items'
+# a cursor per export process, a few connections are plenty
+MAX_POOL_SIZE = 16
+BATCH_SIZE = 10000
+WORKERS = os.cpu_count() or 1
+# run metrics, .json or a Prometheus textfile (.prom), {file} is the output file name
+METRICS_PATH = None
+# export only documents added since the last incremental export, to a new dated file each run
+INCREMENTAL = False
+# filter of the export, e.g. {'file': './csv_data/a.csv'} or {'country': 'US'}; file and hash are indexed
+EXPORT_QUERY = None
+# seconds an incremental export stays behind the clock, for inserts in flight and client clock skew
+EXPORT_LAG = 60
 
 
 def setup_logger():
@@ -36,11 +58,17 @@ def setup_logger():
 
 
 class MongoToFile:
-    def __init__(self, output_csv):
+    def __init__(self, output_csv, max_rows=None, max_bytes=None, metrics_callbacks=None, metrics_path=METRICS_PATH):
+        # the suffix picks the sink: .csv, .csv.gz, .csv.bz2, .csv.xz or .parquet
         if output_csv:
-            self.__output_csv = output_csv + '.csv' if not str(output_csv).lower().endswith('.csv') else output_csv
+            self.__output_csv = normalize_output(output_csv)
         else:
             self.__output_csv = None
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.metrics_callbacks = metrics_callbacks
+        self.metrics_path = metrics_path
+        self.metrics = None
 
         # set mongo credentials
         self.mongo_uri = MONGO_URI
@@ -49,149 +77,151 @@ class MongoToFile:
 
     def __enter__(self):
         # initialize mongodb client
-        self.client = MongoClient(self.mongo_uri, maxPoolSize=50000)
+        self.client = MongoClient(self.mongo_uri, maxPoolSize=MAX_POOL_SIZE)
         self.db = self.client[self.mongo_db]
         self.collection = self.db[self.mongo_collection]
 
-        hdr = [
-            ('Name', 'Name'),
-            ('Website', 'Website'),
-            ('Type', 'Type'),
-            ('subtypes', 'subtypes'),
-            ('Phone', 'Phone'),
-            ('full_address', 'full_address'),
-            ('borough', 'borough'),
-            ('street', 'street'),
-            ('city', 'city'),
-            ('postal_code', 'postal_code'),
-            ('country', 'country'),
-            ('latitude', 'latitude'),
-            ('longitude', 'longitude'),
-            ('time_zone', 'time_zone'),
-            ('plus_code', 'plus_code'),
-            ('rating', 'rating'),
-            ('reviews', 'reviews'),
-            ('reviews_link', 'reviews_link'),
-            ('photo', 'photo'),
-            ('working_hours_old_format', 'working_hours_old_format'),
-            ('price_range', 'price_range'),
-            ('posts', 'posts'),
-            ('verified', 'verified'),
-            ('reserving_table_link', 'reserving_table_link'),
-            ('booking_appointment_link', 'booking_appointment_link'),
-            ('location_link', 'location_link'),
-            ('email', 'email'),
-            ('email2', 'email2'),
-            ('twitter', 'twitter'),
-            ('linkedin', 'linkedin'),
-            ('facebook', 'facebook'),
-            ('instagram', 'instagram'),
-            ('google_plus', 'google_plus'),
-            ('skype', 'skype'),
-            ('telegram', 'telegram'),
-            ('site_generator', 'site_generator'),
-            ('site_title', 'site_title'),
-            ('site_description', 'site_description'),
-            ('site_keywords', 'site_keywords')]
-        self.csv_header = OrderedDict(hdr)
-        self.field_names = list(self.csv_header.keys())
+        self.csv_header = CSV_HEADER
+        self.field_names = FIELD_NAMES
+        self.mapper = RowMapper(self.field_names)
 
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.client.close()
         del self
 
-    def export_to_csv(self):
+    def export_to_csv(self, batch_size=BATCH_SIZE, query=None, write_header=True):
         # start time of script
         start_time = time.time()
 
-        # make an API call to the MongoDB server
-        cursor = self.collection.find()
-
-        # extract the list of documents from cursor obj
-        mongo_docs = list(cursor)
-
-        # restrict the number of docs to export
-        # mongo_docs = mongo_docs[:50]  # slice the list
-        logger.info("total docs: {}".format(len(mongo_docs)))
-
-        # create an empty DataFrame for storing documents
-        # docs = pandas.DataFrame(columns=[])
-
-        with open(self.__output_csv, 'w+', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=self.field_names, quoting=csv.QUOTE_ALL)
-            writer.writerow(self.csv_header)
-
-            # iterate over the list of MongoDB dict documents
-            for num, doc in enumerate(mongo_docs):
-
-                # item = {
-                #     'Name': doc['Name'] if 'Name' in doc else '',
-                #     'Website': doc['Website'] if 'Website' in doc else '',
-                #     'Type': doc['Type'] if 'Type' in doc else '',
-                #     'subtypes': doc['subtypes'] if 'subtypes' in doc else '',
-                #     'Phone': doc['Phone'] if 'Phone' in doc else '',
-                #     'full_address': doc['full_address'] if 'full_address' in doc else '',
-                #     'borough': doc['borough'] if 'borough' in doc else '',
-                #     'street': doc['street'] if 'street' in doc else '',
-                #     'city': doc['city'] if 'city' in doc else '',
-                #     'postal_code': doc['postal_code'] if 'postal_code' in doc else '',
-                #     'country': doc['country'] if 'country' in doc else '',
-                #     'latitude': doc['latitude'] if 'latitude' in doc else '',
-                #     'longitude': doc['longitude'] if 'longitude' in doc else '',
-                #     'time_zone': doc['time_zone'] if 'time_zone' in doc else '',
-                #     'plus_code': doc['plus_code'] if 'plus_code' in doc else '',
-                #     'rating': doc['rating'] if 'rating' in doc else '',
-                #     'reviews': doc['reviews'] if 'reviews' in doc else '',
-                #     'reviews_link': doc['reviews_link'] if 'reviews_link' in doc else '',
-                #     'photo': doc['photo'] if 'photo' in doc else '',
-                #     'working_hours_old_format': doc[
-                #         'working_hours_old_format'] if 'working_hours_old_format' in doc else '',
-                #     'price_range': doc['price_range'] if 'price_range' in doc else '',
-                #     'posts': doc['posts'] if 'posts' in doc else '',
-                #     'verified': doc['verified'] if 'verified' in doc else '',
-                #     'reserving_table_link': doc['reserving_table_link'] if 'reserving_table_link' in doc else '',
-                #     'booking_appointment_link': doc[
-                #         'booking_appointment_link'] if 'booking_appointment_link' in doc else '',
-                #     'location_link': doc['location_link'] if 'location_link' in doc else '',
-                #     'email': doc['email'] if 'email' in doc else '',
-                #     'email2': doc['email2'] if 'email2' in doc else '',
-                #     'twitter': doc['twitter'] if 'twitter' in doc else '',
-                #     'linkedin': doc['linkedin'] if 'linkedin' in doc else '',
-                #     'facebook': doc['facebook'] if 'facebook' in doc else '',
-                #     'instagram': doc['instagram'] if 'instagram' in doc else '',
-                #     'google_plus': doc['google_plus'] if 'google_plus' in doc else '',
-                #     'skype': doc['skype'] if 'skype' in doc else '',
-                #     'telegram': doc['telegram'] if 'telegram' in doc else '',
-                #     'site_generator': doc['site_generator'] if 'site_generator' in doc else '',
-                #     'site_title': doc['site_title'] if 'site_title' in doc else '',
-                #     'site_description': doc['site_description'] if 'site_description' in doc else '',
-                #     'site_keywords': doc['site_keywords'] if 'site_keywords' in doc else '',
-                # }
-
-                item = {}
-                for field in self.field_names:
-                    item[field] = doc[field] if field in doc else ''
-                writer.writerow(item)
-
-                # convert ObjectId() to str
-                # doc["_id"] = str(doc["_id"])
-
-                # get document _id from dict
-                # doc_id = doc["_id"]
-
-                # create a Series obj from the MongoDB dict
-                # series_obj = pandas.Series(doc, name=doc_id)
-
-                # append the MongoDB Series obj to the DataFrame obj
-                # docs = docs.append(series_obj)
-
-                # only print every 10th document
-                if num % 10000 == 0:
-                    logger.info('Writing: {} rows.'.format(num))
-                    f.flush()
+        # only ask the server for the exported fields, hash/file/_id are never sent
+        projection = dict.fromkeys(self.field_names, 1)
+        projection['_id'] = 0
+
+        # stream documents from the server in batches instead of loading them all in memory
+        cursor = self.collection.find(query or {}, projection=projection, batch_size=batch_size)
+        if not query:
+            logger.info("total docs: {}".format(self.collection.estimated_document_count()))
+
+        metrics = self.metrics = Metrics('mongo_to_csv', {'file': self.__output_csv}, self.metrics_callbacks)
+        with open_sink(self.__output_csv, self.field_names, max_rows=self.max_rows, max_bytes=self.max_bytes,
+                       write_header=write_header) as sink:
+            num = 0
+            buffer = []
+            from_document = self.mapper.from_document
+            laps = metrics.laps()
+            for doc in cursor:
+                buffer.append(from_document(doc))
+                if len(buffer) >= batch_size:
+                    laps.lap('fetch')
+                    sink.writerows(buffer)
+                    metrics.observe_flush(laps.lap('write'), len(buffer))
+                    num += len(buffer)
+                    buffer = []
+                    logger.debug('Writing: {} rows.'.format(num))
+
+            laps.lap('fetch')
+            if buffer:
+                sink.writerows(buffer)
+                metrics.observe_flush(laps.lap('write'), len(buffer))
+                num += len(buffer)
+            logger.info('Total written: {} rows.'.format(num))
+        # compressed sinks finish writing in the background until closed
+        laps.lap('write')
+
+        if len(sink.files) > 1:
+            logger.info('Written files: {}'.format(', '.join(path for path, _ in sink.files)))
+
+        metrics.incr('rows_read', num)
+        metrics.incr('bytes_written', sum(os.path.getsize(path) for path, _ in sink.files))
+        metrics.finish(metrics_path(self.metrics_path, self.__output_csv))
+        logger.info("\n\n==== time elapsed: {}".format(time.time() - start_time))
+        return num
+
+    def export_incremental(self, query=None, batch_size=BATCH_SIZE, checkpoint_dir=CHECKPOINT_DIR, lag=EXPORT_LAG):
+        """Exports the documents matching `query` added since the last incremental export with the same filter.
+        ObjectIds start with their creation time, so the new documents are an _id index range between the
+        watermark of the last run and a cutoff `lag` seconds ago. The cutoff becomes the watermark once the
+        file is written, a failed run exports the same range again. Returns the number of rows exported.
+        """
+        name = 'mongo_to_csv:{}.{}:{}'.format(self.mongo_db, self.mongo_collection,
+                                              json.dumps(query, sort_keys=True, default=str))
+        watermark = Watermark(name, checkpoint_dir)
+        after, exported = watermark.load()
+        cutoff = ObjectId.from_datetime(datetime.datetime.now(datetime.timezone.utc) -
+                                        datetime.timedelta(seconds=lag))
+        window = {'_id': {'$lt': cutoff}}
+        if after is not None:
+            window['_id']['$gte'] = after
+
+        num = self.export_to_csv(batch_size, query={'$and': [query, window]} if query else window)
+        watermark.save(cutoff, exported + num)
+        logger.info('Exported {} new rows up to {}.'.format(num, cutoff.generation_time))
+        return num
+
+    def split_ranges(self, parts):
+        """Splits the collection into at most `parts` contiguous _id ranges of roughly equal size.
+        Returns a list of (lower, upper) bounds, lower inclusive and upper exclusive; None means unbounded.
+        """
+        pipeline = [
+            {'$project': {'_id': 1}},
+            {'$bucketAuto': {'groupBy': '$_id', 'buckets': parts}},
+        ]
+        boundaries = [bucket['_id']['min'] for bucket in self.collection.aggregate(pipeline, allowDiskUse=True)]
+        if not boundaries:
+            return []
+
+        # open both ends so nothing inserted meanwhile at the edges is missed
+        boundaries[0] = None
+        return list(zip(boundaries, boundaries[1:] + [None]))
+
+    def export_parallel(self, workers=WORKERS, batch_size=BATCH_SIZE, concat=True):
+        """Exports each _id range in its own process to a part file.
+        With `concat` the parts are joined into the output csv with a single header and removed,
+        compressed parts are joined as concatenated streams. Returns the part files when not concatenated.
+        """
+        start_time = time.time()
+        root, ext = split_suffix(self.__output_csv)
+        if concat and ext.lower() == '.parquet':
+            raise ValueError('Parquet parts can not be concatenated, export with concat=False.')
+
+        ranges = self.split_ranges(workers)
+        part_files = ['{}.part-{:04d}{}'.format(root, i, ext) for i in range(len(ranges))]
+        # concatenated parts get the header once, parts kept on their own each start with it
+        tasks = [(part_file, lower, upper, batch_size, not concat)
+                 for part_file, (lower, upper) in zip(part_files, ranges)]
+
+        with Pool(processes=workers) as pool:
+            total = sum(pool.map(export_part, tasks, chunksize=1))
+        logger.info('Exported {} rows into {} parts.'.format(total, len(part_files)))
+
+        if not concat:
+            return part_files
+
+        with open_text(self.__output_csv) as f:
+            csv.writer(f, quoting=csv.QUOTE_ALL).writerow(self.field_names)
+        with open(self.__output_csv, 'ab') as f:
+            for part_file in part_files:
+                with open(part_file, 'rb') as part:
+                    shutil.copyfileobj(part, f)
+                os.remove(part_file)
 
         logger.info("\n\n==== time elapsed: {}".format(time.time() - start_time))
+        return [self.__output_csv]
+
+
+def export_part(task):
+    part_file, lower, upper, batch_size, write_header = task
+    query = {}
+    if lower is not None:
+        query['$gte'] = lower
+    if upper is not None:
+        query['$lt'] = upper
+
+    with MongoToFile(part_file) as converter:
+        return converter.export_to_csv(batch_size, query={'_id': query} if query else None,
+                                       write_header=write_header)
 
 
 if __name__ == '__main__':
@@ -199,5 +229,13 @@ if __name__ == '__main__':
     # mode = int(input('Please specify Mode (1 for db insert, 2 for csv export!): '))
 
     output_file = './output.csv'  # input('Please specify Input csv: ')
+    if INCREMENTAL:
+        # every delta gets its own file
+        output_file = datetime.datetime.now().strftime('./output_%Y%m%d_%H%M%S.csv')
     with MongoToFile(output_file) as converter:
-        converter.export_to_csv()
+        if INCREMENTAL:
+            converter.export_incremental(EXPORT_QUERY)
+        elif WORKERS > 1 and not EXPORT_QUERY:
+            converter.export_parallel(WORKERS)
+        else:
+            converter.export_to_csv(query=EXPORT_QUERY)
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""Near-duplicate detection for business rows.
+
+Rows are canonicalized, grouped into blocks by postal code (or city) with an external sort, and within
+each block MinHash/LSH proposes candidate pairs which are verified on their exact shingle similarity.
+Verified pairs are merged into clusters and every duplicate is mapped to the cluster's surviving row.
+Memory is bounded by the largest block and the work per row is constant, so the run is near-linear.
+"""
+import csv
+import glob
+import heapq
+import logging
+import os
+import pickle
+import random
+import re
+import tempfile
+import unicodedata
+import zlib
+from collections import defaultdict
+from itertools import groupby
+from logging.handlers import RotatingFileHandler
+
+from schema import FIELD_NAMES, RowMapper
+
+logger = logging.getLogger(__name__)
+
+NUM_PERM = 32
+BANDS = 8
+# minimum shingle similarity of a duplicate, lower when both rows have the same phone number
+SIMILARITY = 0.7
+PHONE_SIMILARITY = 0.5
+# previous members of an LSH bucket each row is compared with, keeps hot buckets linear
+COMPARE_LIMIT = 5
+SHINGLE_SIZE = 3
+RUN_SIZE = 1000000
+SEED = 1
+MAPPING_PATH = './near_duplicates.csv'
+
+PUNCTUATION = re.compile(r'[^\w\s]')
+SPACES = re.compile(r'\s+')
+NAME_STOPWORDS = {'the', 'inc', 'llc', 'ltd', 'co', 'corp', 'corporation', 'company', 'limited'}
+ADDRESS_ABBREVIATIONS = {
+    'street': 'st', 'avenue': 'ave', 'av': 'ave', 'road': 'rd', 'boulevard': 'blvd', 'drive': 'dr',
+    'lane': 'ln', 'court': 'ct', 'place': 'pl', 'square': 'sq', 'parkway': 'pkwy', 'highway': 'hwy',
+    'suite': 'ste', 'apartment': 'apt', 'floor': 'fl', 'building': 'bldg', 'terrace': 'ter',
+    'north': 'n', 'south': 's', 'east': 'e', 'west': 'w',
+    'northeast': 'ne', 'northwest': 'nw', 'southeast': 'se', 'southwest': 'sw',
+    'first': '1st', 'second': '2nd', 'third': '3rd', 'fourth': '4th', 'fifth': '5th',
+}
+
+
+def setup_logger():
+    logger.setLevel(logging.DEBUG)
+
+    # create formatter and add it to the handlers
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    # create file handler which logs even debug messages
+    fh = RotatingFileHandler('csv_cleaner.log', maxBytes=10 * 1024 * 1024, backupCount=5)
+    fh.setLevel(logging.INFO)
+    fh.setFormatter(formatter)
+
+    # create console handler with a higher log level
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    ch.setFormatter(formatter)
+
+    # add the handlers to the logger
+    logger.addHandler(fh)
+    logger.addHandler(ch)
+
+
+def _words(value):
+    value = unicodedata.normalize('NFKD', value or '').encode('ascii', 'ignore').decode('ascii').lower()
+    # joe's -> joes, a&b -> a and b
+    value = value.replace("'", '').replace('&', ' and ')
+    return SPACES.sub(' ', PUNCTUATION.sub(' ', value)).split()
+
+
+def canonical_name(name):
+    return ' '.join(word for word in _words(name) if word not in NAME_STOPWORDS)
+
+
+def canonical_address(address):
+    return ' '.join(ADDRESS_ABBREVIATIONS.get(word, word) for word in _words(address))
+
+
+def canonical_phone(phone):
+    digits = ''.join(c for c in phone or '' if c.isdigit())
+    # compare national numbers, with or without the country code
+    return digits[-10:]
+
+
+def block_key(record):
+    """Blocks rows by postal code, rows without one by city."""
+    postal_code = (record.get('postal_code') or '').strip().lower().replace(' ', '')
+    if postal_code:
+        return 'p:' + postal_code
+    city = ' '.join(_words(record.get('city')))
+    return 'c:' + city if city else ''
+
+
+def shingles(name, address, size=SHINGLE_SIZE):
+    """Character shingles of the canonical name and address, tagged so the fields never match each other."""
+    result = set()
+    for tag, value in (('n', name), ('a', address)):
+        if len(value) <= size:
+            if value:
+                result.add(tag + value)
+            continue
+        for i in range(len(value) - size + 1):
+            result.add(tag + value[i:i + size])
+    return result
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class NearDuplicateFinder:
+    """Finds near-duplicate rows and maps each duplicate to the surviving row of its cluster.
+
+    Rows are added with `add(record_id, record)`, canonicalized at once and spilled to disk in sorted
+    runs of `run_size` rows. `find` merges the runs block by block and yields
+    (duplicate_id, survivor_id, similarity, block). The survivor is the most complete row of a cluster,
+    the first one added on a tie.
+    """
+
+    def __init__(self, similarity=SIMILARITY, phone_similarity=PHONE_SIMILARITY, num_perm=NUM_PERM, bands=BANDS,
+                 run_size=RUN_SIZE, seed=SEED):
+        if num_perm % bands:
+            raise ValueError('num_perm must be a multiple of bands.')
+        self.similarity = similarity
+        self.phone_similarity = phone_similarity
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+        # MinHash permutations as xor masks over crc32 shingle hashes, which unlike hash() are the same in every
+        # process, so the same input always gives the same mapping
+        rng = random.Random(seed)
+        self.masks = [rng.getrandbits(32) for _ in range(num_perm)]
+        self.run_size = run_size
+        self.stats = defaultdict(int)
+        self.__run = []
+        self.__runs = []
+        self.__seq = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        for run in self.__runs:
+            run.close()
+        self.__runs = []
+        self.__run = []
+
+    def add(self, record_id, record):
+        block = block_key(record)
+        if not block:
+            self.stats['unblocked'] += 1
+            return
+
+        completeness = sum(1 for field in FIELD_NAMES if record.get(field) not in (None, ''))
+        self.__run.append((block, self.__seq, str(record_id), canonical_name(record.get('Name')),
+                           canonical_address(record.get('full_address')), canonical_phone(record.get('Phone')),
+                           completeness))
+        self.__seq += 1
+        if len(self.__run) >= self.run_size:
+            self.__spill()
+
+    def find(self):
+        self.__run.sort()
+        rows = heapq.merge(self.__run, *[self.__run_iter(run) for run in self.__runs])
+        for block, members in groupby(rows, key=lambda row: row[0]):
+            self.stats['blocks'] += 1
+            yield from self.__find_in_block(block, list(members))
+
+        logger.info('Near duplicates: {} rows in {} blocks ({} without postal code or city), {} candidate pairs, '
+                    '{} verified, {} duplicates in {} clusters.'.format(
+                        self.stats['rows'], self.stats['blocks'], self.stats['unblocked'], self.stats['candidates'],
+                        self.stats['verified'], self.stats['duplicates'], self.stats['clusters']))
+
+    def write_mapping(self, path=MAPPING_PATH):
+        """Writes the duplicate -> survivor mapping as csv, returns the number of duplicates."""
+        count = 0
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['duplicate_id', 'survivor_id', 'similarity', 'block'])
+            for duplicate_id, survivor_id, similarity, block in self.find():
+                writer.writerow([duplicate_id, survivor_id, '{:.3f}'.format(similarity), block])
+                count += 1
+        os.replace(tmp_path, path)
+        logger.info('Wrote {} duplicate mappings to: {}'.format(count, path))
+        return count
+
+    def signature(self, shingle_set):
+        hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingle_set]
+        return [min(map(mask.__xor__, hashes)) for mask in self.masks]
+
+    def __find_in_block(self, block, members):
+        self.stats['rows'] += len(members)
+        if len(members) < 2:
+            return
+
+        sets = [shingles(member[3], member[4]) for member in members]
+        parent = list(range(len(members)))
+
+        def find_root(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        buckets = defaultdict(list)
+        r = self.rows_per_band
+        for i, shingle_set in enumerate(sets):
+            if not shingle_set:
+                continue
+            signature = self.signature(shingle_set)
+            for band in range(self.bands):
+                bucket = buckets[(band, tuple(signature[band * r:(band + 1) * r]))]
+                for j in bucket[-COMPARE_LIMIT:]:
+                    if find_root(i) == find_root(j):
+                        continue
+                    self.stats['candidates'] += 1
+                    if self.__is_duplicate(members[i], members[j], sets[i], sets[j]):
+                        self.stats['verified'] += 1
+                        parent[find_root(i)] = find_root(j)
+                bucket.append(i)
+
+        clusters = defaultdict(list)
+        for i in range(len(members)):
+            clusters[find_root(i)].append(i)
+
+        for cluster in clusters.values():
+            if len(cluster) < 2:
+                continue
+            self.stats['clusters'] += 1
+            # most filled in fields first, then the row added first
+            survivor = max(cluster, key=lambda i: (members[i][6], -members[i][1]))
+            for i in cluster:
+                if i != survivor:
+                    self.stats['duplicates'] += 1
+                    yield members[i][2], members[survivor][2], jaccard(sets[i], sets[survivor]), block
+
+    def __is_duplicate(self, a, b, set_a, set_b):
+        threshold = self.phone_similarity if a[5] and a[5] == b[5] else self.similarity
+        return jaccard(set_a, set_b) >= threshold
+
+    def __spill(self):
+        self.__run.sort()
+        f = tempfile.TemporaryFile()
+        for row in self.__run:
+            pickle.dump(row, f, pickle.HIGHEST_PROTOCOL)
+        f.seek(0)
+        self.__runs.append(f)
+        self.__run = []
+
+    @staticmethod
+    def __run_iter(f):
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                break
+
+
+def iter_csv_records(input_files):
+    """Yields (file:row, record) for every row of the csv files."""
+    mapper = RowMapper()
+    for input_csv in input_files:
+        with open(input_csv, 'r', encoding='utf-8', errors='ignore', newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for index, row in enumerate(reader, 1):
+                record = mapper.fit(row)
+                if record is not None:
+                    yield '{}:{}'.format(input_csv, index), mapper.to_dict(record)
+
+
+def iter_mongo_records(collection, batch_size=10000):
+    """Yields (_id, document) for every document, only the fields used for matching are fetched."""
+    projection = dict.fromkeys(FIELD_NAMES, 1)
+    for doc in collection.find({}, projection=projection, batch_size=batch_size):
+        yield doc['_id'], doc
+
+
+def iter_sql_records(converter, batch_size=10000):
+    """Yields (id, record) for every row of a csv_to_mysql converter's table."""
+    model = converter.model
+    columns = [getattr(model, field) for field in FIELD_NAMES]
+    for values in converter.keyset_scan(model.id, *columns, batch_size=batch_size):
+        yield values[0], dict(zip(FIELD_NAMES, values[1:]))
+
+
+if __name__ == '__main__':
+    setup_logger()
+
+    input_directory = './csv_data'  # input('Please specify Input csv: ')
+    input_files = sorted(glob.glob('{}/*.csv'.format(input_directory)))
+    with NearDuplicateFinder() as finder:
+        for record_id, record in iter_csv_records(input_files):
+            finder.add(record_id, record)
+        finder.write_mapping(MAPPING_PATH)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import csv
+import io
+import logging
+import mmap
+import multiprocessing
+import os
+from collections import Counter, deque
+
+from checkpoint import OffsetReader
+from dedup_index import digest, make_hash
+from schema import MIN_COLUMNS, RowMapper, TypedFields, encoded_size
+
+logger = logging.getLogger(__name__)
+
+PARSE_WORKERS = os.cpu_count() or 1
+CHUNK_BYTES = 4 * 1024 * 1024
+# parsed chunks waiting per worker, bounds the memory held by results not consumed yet
+PREFETCH = 2
+QUOTE = b'"'
+NEWLINE = b'\n'
+
+
+def record_chunks(buf, start=0, chunk_bytes=CHUNK_BYTES):
+    """Splits buf[start:] into (start, end) byte ranges of about `chunk_bytes` which end on a record boundary.
+    A newline only ends a record when the quotes before it are balanced, so quoted fields with embedded
+    newlines never straddle two chunks. `start` must itself be a record boundary.
+    """
+    size = len(buf)
+    while start < size:
+        pos = min(start + chunk_bytes, size)
+        quotes = buf[start:pos].count(QUOTE)
+        end = size
+        while pos < size:
+            newline = buf.find(NEWLINE, pos)
+            if newline == -1:
+                break
+            quotes += buf[pos:newline + 1].count(QUOTE)
+            pos = newline + 1
+            if quotes % 2 == 0:
+                end = pos
+                break
+        yield start, end
+        start = end
+
+
+def parse_chunk(task):
+    """Parses and maps the records of one byte range, runs in a pool worker.
+    Returns (rows, records, short_rows, row_errors, failures, rejected_rows), with records as
+    (row, end, record, hash, key, nbytes) where `row` counts the rows of the chunk up to the record
+    and `end` is the byte offset in the file after it.
+    """
+    path, start, end, header, typed, widths = task
+    mapper = RowMapper()
+    typed_fields = TypedFields(mapper.field_names, widths) if typed else None
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        data = mm[start:end]
+
+    lines = OffsetReader(io.BytesIO(data))
+    reader = csv.reader(lines, quoting=csv.QUOTE_ALL)
+    records = []
+    rows = 0
+    short_rows = 0
+    row_errors = 0
+    for row in reader:
+        rows += 1
+        if (header and rows == 1) or not row:
+            continue
+
+        try:
+            record = mapper.fit(row)
+            if record is None:
+                short_rows += 1
+                continue
+            nbytes = encoded_size(record)
+            hash = make_hash(*mapper.key(record))
+            if typed_fields:
+                typed_fields.parse(record)
+            records.append((rows, start + lines.offset, record, hash, digest(hash), nbytes))
+        except Exception:
+            row_errors += 1
+
+    failures = typed_fields.failures if typed_fields else Counter()
+    rejected_rows = typed_fields.rejected_rows if typed_fields else 0
+    return rows, records, short_rows, row_errors, failures, rejected_rows
+
+
+class ChunkedCsvReader:
+    """Parses one csv file in a process pool, so a single huge file can use every core.
+
+    The file is memory-mapped and split into record aligned byte ranges (see `record_chunks`). Workers parse,
+    fit, hash and optionally type the rows of a range, results come back in file order. Iterating yields
+    (row, end, record, hash, key, nbytes) per record, where `row` and `end` are the row index and byte
+    offset after the record, ready for a checkpoint. After the loop `index` and `offset` are the end of the file.
+
+    Chunks are split on quote parity, which holds for files where quotes only enclose fields (RFC 4180).
+    Pool workers can not have children, so inside a pool worker the chunks are parsed in process.
+    `widths` are the text column widths typed rows are checked against (see TypedFields).
+    """
+
+    def __init__(self, input_csv, offset=0, index=0, typed=False, workers=PARSE_WORKERS, chunk_bytes=CHUNK_BYTES,
+                 widths=None):
+        self.input_csv = input_csv
+        self.offset = offset
+        self.index = index
+        self.typed = typed
+        self.widths = widths
+        self.workers = workers
+        self.chunk_bytes = chunk_bytes
+        self.chunks = 0
+        self.short_rows = 0
+        self.row_errors = 0
+        self.failures = Counter()
+        self.rejected_rows = 0
+
+    def __iter__(self):
+        if not os.path.getsize(self.input_csv):
+            return
+
+        with open(self.input_csv, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # the header is the first row of the file, a resumed run starts after it
+            tasks = ((self.input_csv, start, end, start == 0, self.typed, self.widths)
+                     for start, end in record_chunks(mm, self.offset, self.chunk_bytes))
+            if multiprocessing.current_process().daemon:
+                logger.warning('Parsing {} in process, pool workers can not start a parser pool.'.format(
+                    self.input_csv))
+                for task in tasks:
+                    yield from self.__consume(task[2], parse_chunk(task))
+                return
+
+            with multiprocessing.Pool(self.workers) as pool:
+                pending = deque()
+                for task in tasks:
+                    pending.append((task[2], pool.apply_async(parse_chunk, (task,))))
+                    if len(pending) >= self.workers * PREFETCH:
+                        end, result = pending.popleft()
+                        yield from self.__consume(end, result.get())
+
+                while pending:
+                    end, result = pending.popleft()
+                    yield from self.__consume(end, result.get())
+
+    def __consume(self, end, result):
+        rows, records, short_rows, row_errors, failures, rejected_rows = result
+        index = self.index
+        for row, record_end, record, hash, key, nbytes in records:
+            yield index + row, record_end, record, hash, key, nbytes
+
+        self.index = index + rows
+        self.offset = end
+        self.chunks += 1
+        self.short_rows += short_rows
+        self.row_errors += row_errors
+        self.failures.update(failures)
+        self.rejected_rows += rejected_rows
+
+    def report(self, metrics=None, typed_fields=None):
+        """Logs the rows the workers skipped and merges their counts into metrics and typed fields."""
+        if self.short_rows:
+            logger.warning('{}: {} rows with less than {} columns.'.format(
+                self.input_csv, self.short_rows, MIN_COLUMNS))
+        if self.row_errors:
+            logger.error('{}: {} rows failed to parse.'.format(self.input_csv, self.row_errors))
+        if metrics:
+            metrics.incr('short_rows', self.short_rows)
+            metrics.incr('row_errors', self.row_errors)
+            metrics.incr('chunks', self.chunks)
+        if typed_fields:
+            typed_fields.failures.update(self.failures)
+            typed_fields.rejected_rows += self.rejected_rows
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = 4
+BATCH_BYTES = 1024 * 1024
+MIN_BATCH_BYTES = 64 * 1024
+MAX_LATENCY = 2.0
+
+
+class BatchPipeline:
+    """Flushes batches from writer threads while the caller keeps parsing, linked by a bounded queue.
+
+    `open_writer` is called once in every writer thread and returns a (load, close) pair, so each thread
+    can own its connection; `close` may be None. Batches complete in any order but `on_commit(result, token, seconds)`
+    runs on the caller thread strictly in submit order, so checkpoints and dedup keys only ever move past
+    rows which are stored. With `writers=0` batches are loaded inline, same as before pipelining.
+    """
+    _DONE = object()
+
+    def __init__(self, open_writer, on_commit=None, writers=0, queue_size=QUEUE_SIZE):
+        self.open_writer = open_writer
+        self.on_commit = on_commit
+        self.writers = writers
+        self.error = None
+        self.closed = False
+        self.parse_time = 0.0
+        self.blocked_time = 0.0
+        self.write_time = 0.0
+        self.idle_time = 0.0
+        self.batches = 0
+        self.__tokens = {}
+        self.__done = {}
+        self.__submitted = 0
+        self.__committed = 0
+        self.__lock = threading.Lock()
+        self.__start = time.time()
+        self.__mark = self.__start
+
+        if writers:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.threads = [threading.Thread(target=self.__run, daemon=True) for _ in range(writers)]
+            for thread in self.threads:
+                thread.start()
+        else:
+            self.threads = []
+            self.load, self.close_writer = open_writer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            # stop the writers and keep what was stored, the caller's exception wins
+            self.closed = True
+            self.__join()
+            self.__commit()
+        else:
+            self.close()
+
+    def submit(self, batch, token=None):
+        """Queues a batch, blocks while the queue is full."""
+        if self.error:
+            raise self.error
+
+        start = time.time()
+        self.parse_time += start - self.__mark
+        seq = self.__submitted
+        self.__submitted += 1
+        self.__tokens[seq] = token
+
+        if self.writers:
+            self.queue.put((seq, batch))
+            self.__mark = time.time()
+            self.blocked_time += self.__mark - start
+        else:
+            result = self.load(batch)
+            self.__mark = time.time()
+            self.write_time += self.__mark - start
+            self.__done[seq] = (result, self.__mark - start)
+        self.batches += 1
+        self.__commit()
+
+    def close(self):
+        """Waits for the queued batches, commits them and logs where the time went."""
+        if self.closed:
+            return
+        self.closed = True
+        self.parse_time += time.time() - self.__mark
+        self.__join()
+        self.__commit()
+        if self.error:
+            raise self.error
+        self.log_stats()
+
+    def stats(self):
+        elapsed = time.time() - self.__start
+        if self.writers:
+            # the parser waiting on a full queue means the writers are behind, idle writers mean the parser is
+            bottleneck = 'write' if self.blocked_time > self.idle_time / self.writers else 'parse'
+        else:
+            bottleneck = 'write' if self.write_time > self.parse_time else 'parse'
+        return {
+            'batches': self.batches,
+            'writers': self.writers,
+            'elapsed': elapsed,
+            'parse': self.parse_time,
+            'blocked': self.blocked_time,
+            'write': self.write_time,
+            'idle': self.idle_time,
+            'bottleneck': bottleneck,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info('Pipeline: {} batches in {:.2f}s, parse {:.2f}s, blocked on full queue {:.2f}s, '
+                    'write {:.2f}s over {} writers, writers idle {:.2f}s, bottleneck: {}.'.format(
+                        stats['batches'], stats['elapsed'], stats['parse'], stats['blocked'], stats['write'],
+                        max(stats['writers'], 1), stats['idle'], stats['bottleneck']))
+
+    def __commit(self):
+        while True:
+            with self.__lock:
+                if self.__committed not in self.__done:
+                    return
+                result, seconds = self.__done.pop(self.__committed)
+            token = self.__tokens.pop(self.__committed)
+            self.__committed += 1
+            if self.on_commit:
+                self.on_commit(result, token, seconds)
+
+    def __join(self):
+        if self.writers:
+            for thread in self.threads:
+                if thread.is_alive():
+                    self.queue.put(self._DONE)
+            for thread in self.threads:
+                thread.join()
+        elif self.close_writer:
+            self.close_writer()
+            self.close_writer = None
+
+    def __run(self):
+        close = None
+        try:
+            load, close = self.open_writer()
+            while True:
+                wait = time.time()
+                item = self.queue.get()
+                start = time.time()
+                if item is self._DONE:
+                    break
+
+                seq, batch = item
+                result = load(batch)
+                seconds = time.time() - start
+                with self.__lock:
+                    self.__done[seq] = (result, seconds)
+                    self.idle_time += start - wait
+                    self.write_time += seconds
+        except Exception as x:
+            logger.error('Error when writing a batch. Details: {}'.format(x))
+            self.error = x
+            # drain so the parser never blocks on a dead writer
+            while self.queue.get() is not self._DONE:
+                pass
+        finally:
+            if close:
+                close()
+
+
+class AdaptiveBatcher:
+    """Decides when a batch is full from the encoded bytes of its rows instead of a fixed row count.
+
+    The byte target starts at `target_bytes` and is tuned from the measured flush latency: it grows while
+    bigger batches still raise the throughput, steps back to the best size seen once they stop paying off
+    and shrinks when a flush takes longer than `max_latency`. It never exceeds `max_bytes` or `max_rows`,
+    a batch only overshoots the byte target by its last row.
+    """
+
+    def __init__(self, max_bytes, max_rows=None, target_bytes=BATCH_BYTES, min_bytes=MIN_BATCH_BYTES,
+                 max_latency=MAX_LATENCY, row_overhead=0):
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.min_bytes = min(min_bytes, max_bytes)
+        self.target = max(self.min_bytes, min(target_bytes, max_bytes))
+        self.max_latency = max_latency
+        self.row_overhead = row_overhead
+        self.rows = 0
+        self.bytes = 0
+        self.best_rate = 0.0
+        self.best_target = self.target
+        self.__flushed = deque()
+        self.__sizes = []
+
+    def add(self, nbytes):
+        """Counts a row of `nbytes` encoded bytes, returns True when the batch should be flushed."""
+        self.rows += 1
+        self.bytes += nbytes + self.row_overhead
+        if self.bytes >= self.target or (self.max_rows and self.rows >= self.max_rows):
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        """Closes the current batch, returns False when it is empty."""
+        if not self.rows:
+            return False
+        full = self.bytes >= self.target or bool(self.max_rows and self.rows >= self.max_rows)
+        self.__flushed.append((self.rows, self.bytes, self.target, full))
+        self.rows = 0
+        self.bytes = 0
+        return True
+
+    def observe(self, seconds):
+        """Tunes the byte target from the flush time of the oldest batch not observed yet.
+        Batches are observed in the order they were flushed, returns the (rows, bytes) of the batch.
+        """
+        rows, nbytes, target, full = self.__flushed.popleft()
+        self.__sizes.append((rows, nbytes))
+        if not full:
+            # the tail of a file says nothing about the target
+            return rows, nbytes
+
+        rate = nbytes / max(seconds, 1e-6)
+        if seconds > self.max_latency:
+            self.target = max(self.min_bytes, int(self.target * self.max_latency / seconds))
+        elif rate >= self.best_rate * 0.95:
+            if rate > self.best_rate:
+                self.best_rate = rate
+                self.best_target = target
+            self.target = min(self.max_bytes, int(self.target * 1.5))
+        else:
+            # bigger batches stopped paying off
+            self.target = self.best_target
+        return rows, nbytes
+
+    def stats(self):
+        rows = [size[0] for size in self.__sizes]
+        sizes = [size[1] for size in self.__sizes]
+        return {
+            'batches': len(sizes),
+            'rows_min': min(rows, default=0),
+            'rows_max': max(rows, default=0),
+            'rows_mean': sum(rows) / len(rows) if rows else 0,
+            'bytes_min': min(sizes, default=0),
+            'bytes_max': max(sizes, default=0),
+            'bytes_mean': sum(sizes) / len(sizes) if sizes else 0,
+            'target_bytes': self.target,
+            'best_rate': self.best_rate,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info('Batches: {} flushed, rows {}/{:.0f}/{} and KB {:.0f}/{:.0f}/{:.0f} (min/mean/max), '
+                    'target {:.0f} KB, best {:.2f} MB/s.'.format(
+                        stats['batches'], stats['rows_min'], stats['rows_mean'], stats['rows_max'],
+                        stats['bytes_min'] / 1024, stats['bytes_mean'] / 1024, stats['bytes_max'] / 1024,
+                        stats['target_bytes'] / 1024, stats['best_rate'] / 1024 / 1024))
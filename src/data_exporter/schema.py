@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+import csv
+import logging
+import math
+from collections import Counter, OrderedDict
+from operator import itemgetter
+
+logger = logging.getLogger(__name__)
+
+HEADER = [('Name', 'Name'),
+          ('Website', 'Website'),
+          ('Type', 'Type'),
+          ('subtypes', 'subtypes'),
+          ('Phone', 'Phone'),
+          ('full_address', 'full_address'),
+          ('borough', 'borough'),
+          ('street', 'street'),
+          ('city', 'city'),
+          ('postal_code', 'postal_code'),
+          ('country', 'country'),
+          ('latitude', 'latitude'),
+          ('longitude', 'longitude'),
+          ('time_zone', 'time_zone'),
+          ('plus_code', 'plus_code'),
+          ('rating', 'rating'),
+          ('reviews', 'reviews'),
+          ('reviews_link', 'reviews_link'),
+          ('photo', 'photo'),
+          ('working_hours_old_format', 'working_hours_old_format'),
+          ('price_range', 'price_range'),
+          ('posts', 'posts'),
+          ('verified', 'verified'),
+          ('reserving_table_link', 'reserving_table_link'),
+          ('booking_appointment_link', 'booking_appointment_link'),
+          ('location_link', 'location_link'),
+          ('email', 'email'),
+          ('email2', 'email2'),
+          ('twitter', 'twitter'),
+          ('linkedin', 'linkedin'),
+          ('facebook', 'facebook'),
+          ('instagram', 'instagram'),
+          ('google_plus', 'google_plus'),
+          ('skype', 'skype'),
+          ('telegram', 'telegram'),
+          ('site_generator', 'site_generator'),
+          ('site_title', 'site_title'),
+          ('site_description', 'site_description'),
+          ('site_keywords', 'site_keywords')]
+
+CSV_HEADER = OrderedDict(HEADER)
+FIELD_NAMES = list(CSV_HEADER.keys())
+
+# rows with fewer columns are not business records
+MIN_COLUMNS = 13
+
+FLOAT_FIELDS = ('latitude', 'longitude', 'rating')
+INT_FIELDS = ('reviews',)
+
+# widest value kept in a bounded Unicode column, longer columns stay TEXT
+MAX_BOUNDED_WIDTH = 1000
+
+# range of a MySQL INT column, strict mode rejects the whole batch for one value outside it
+INT_MIN = -2 ** 31
+INT_MAX = 2 ** 31 - 1
+
+
+def parse_float(value):
+    number = float(value)
+    # DOUBLE columns have no nan or inf
+    if not math.isfinite(number):
+        raise ValueError('Not a finite number: {}'.format(value))
+    return number
+
+
+def parse_int(value):
+    # scraped counts come as '1,234' or '12.0'
+    number = parse_float(value.replace(',', ''))
+    if not INT_MIN <= number <= INT_MAX:
+        raise ValueError('Out of the INT range: {}'.format(value))
+    return int(number)
+
+
+PARSERS = dict([(field, parse_float) for field in FLOAT_FIELDS] + [(field, parse_int) for field in INT_FIELDS])
+
+
+def encoded_size(record):
+    """Returns the UTF-8 size of a record's values, the unit batch byte limits are set in."""
+    return len(''.join(record).encode('utf-8'))
+
+
+class RowMapper:
+    """Row mapping compiled once per sink from the shared field list.
+
+    Records are lists in field order. Short rows are padded and long rows cut once in `fit`,
+    the key fields and documents are read through precompiled itemgetters.
+    """
+
+    def __init__(self, field_names=FIELD_NAMES, min_columns=MIN_COLUMNS):
+        self.field_names = list(field_names)
+        self.width = len(self.field_names)
+        self.min_columns = min_columns
+        self.key = itemgetter(self.field_names.index('Name'), self.field_names.index('full_address'))
+        self.document_getter = itemgetter(*self.field_names)
+
+    def fit(self, row):
+        """Returns the csv row as a record of exactly `width` values, None when it is too short."""
+        n = len(row)
+        if n == self.width:
+            return row
+        if n < self.min_columns:
+            return None
+        if n > self.width:
+            return row[:self.width]
+        return row + [''] * (self.width - n)
+
+    def to_dict(self, record):
+        return dict(zip(self.field_names, record))
+
+    def from_document(self, doc):
+        """Returns the exported values of a document in field order, '' for missing fields."""
+        try:
+            return self.document_getter(doc)
+        except KeyError:
+            return tuple(doc.get(field, '') for field in self.field_names)
+
+
+class TypedFields:
+    """Parses the numeric fields of a record in place and counts the values which fail to parse.
+    With `widths` ({field: max length}) text values longer than their column fail as well.
+    Empty and failed values become None, so they are stored as NULL or left out.
+    """
+
+    def __init__(self, field_names=FIELD_NAMES, widths=None):
+        self.positions = [(field_names.index(field), field, parser) for field, parser in PARSERS.items()]
+        self.widths = widths
+        self.bounded = [(field_names.index(field), field, width) for field, width in (widths or {}).items()
+                        if width and field in field_names and field not in PARSERS]
+        self.failures = Counter()
+        self.rejected_rows = 0
+
+    def parse(self, record):
+        failed = False
+        for i, field, parser in self.positions:
+            value = record[i]
+            if value is None or isinstance(value, (int, float)):
+                continue
+
+            value = value.strip()
+            if not value:
+                record[i] = None
+                continue
+
+            try:
+                record[i] = parser(value)
+            except ValueError:
+                record[i] = None
+                self.failures[field] += 1
+                failed = True
+
+        for i, field, width in self.bounded:
+            value = record[i]
+            if value is not None and len(value) > width:
+                record[i] = None
+                self.failures[field] += 1
+                failed = True
+
+        if failed:
+            self.rejected_rows += 1
+        return record
+
+    def report(self, input_csv):
+        if self.rejected_rows:
+            logger.warning('{}: {} rows with values which do not fit their column ({}).'.format(
+                input_csv, self.rejected_rows, ', '.join('{}: {}'.format(k, v) for k, v in self.failures.items())))
+
+
+def bounded_width(length):
+    """Rounds an observed length up to the next power of two, None when it should stay TEXT."""
+    if length > MAX_BOUNDED_WIDTH:
+        return None
+    width = 16
+    while width < length:
+        width *= 2
+    return min(width, MAX_BOUNDED_WIDTH)
+
+
+def column_widths(columns):
+    """Returns the length of every bounded text column, None for TEXT and numeric columns.
+    `columns` are reflected as by sqlalchemy's inspector, {'name': ..., 'type': ...} each.
+    """
+    return {column['name']: getattr(column['type'], 'length', None) for column in columns}
+
+
+def observe_widths(input_files, field_names, min_columns=MIN_COLUMNS):
+    """Scans csv files and returns the bounded width per field, None for fields which need TEXT.
+    Rows shorter than `min_columns` are skipped like the ingesters do.
+    """
+    lengths = Counter()
+    for input_csv in input_files:
+        with open(input_csv, 'r', errors='ignore', newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                if len(row) < min_columns:
+                    continue
+                for field, value in zip(field_names, row):
+                    if len(value) > lengths[field]:
+                        lengths[field] = len(value)
+    return {field: bounded_width(lengths[field]) for field in field_names}
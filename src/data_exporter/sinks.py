@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+import bz2
+import csv
+import gzip
+import logging
+import lzma
+import os
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+COMPRESSORS = {
+    '.gz': gzip.open,
+    '.bz2': bz2.open,
+    '.xz': lzma.open,
+}
+SUFFIXES = ['.csv'] + ['.csv' + ext for ext in COMPRESSORS] + ['.parquet']
+QUEUE_SIZE = 8
+
+
+def normalize_output(path):
+    """Appends .csv unless the path already ends with a supported suffix (.csv, .csv.gz, .csv.bz2, .csv.xz, .parquet)."""
+    if any(str(path).lower().endswith(suffix) for suffix in SUFFIXES):
+        return path
+    return path + '.csv'
+
+
+def split_suffix(path):
+    """Splits a path into its root and full suffix, e.g. ('out', '.csv.gz')."""
+    lower = str(path).lower()
+    for suffix in sorted(SUFFIXES, key=len, reverse=True):
+        if lower.endswith(suffix):
+            return path[:-len(suffix)], path[-len(suffix):]
+    return os.path.splitext(path)
+
+
+def open_text(path, mode='w'):
+    """Opens a text file, compressed according to its suffix."""
+    _, ext = os.path.splitext(str(path).lower())
+    opener = COMPRESSORS.get(ext)
+    if opener:
+        return opener(path, mode + 't', encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def open_sink(path, header=None, max_rows=None, max_bytes=None, threaded=None, write_header=True):
+    """Returns a sink for the path: parquet for .parquet, otherwise a csv sink compressed by suffix.
+    Csv files start with the header unless `write_header` is False, parquet always needs it for the schema.
+    Compressed sinks write from a background thread by default so compression overlaps with reading.
+    """
+    if str(path).lower().endswith('.parquet'):
+        sink = ParquetSink(path, header, max_rows=max_rows, max_bytes=max_bytes)
+    else:
+        sink = CsvSink(path, header, max_rows=max_rows, max_bytes=max_bytes, write_header=write_header)
+
+    if threaded is None:
+        threaded = split_suffix(path)[1].lower() != '.csv'
+    return ThreadedSink(sink) if threaded else sink
+
+
+class _CountingWriter:
+    def __init__(self, f):
+        self.f = f
+        self.bytes = 0
+
+    def write(self, s):
+        self.bytes += len(s)
+        return self.f.write(s)
+
+
+class _RollingSink:
+    """Base of sinks which roll over to a new file after `max_rows` rows or `max_bytes` uncompressed bytes.
+    Without limits a single file is written at `path`, otherwise parts are named <root>-0001<suffix>.
+    """
+
+    def __init__(self, path, header=None, max_rows=None, max_bytes=None):
+        self.path = path
+        self.header = header
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.files = []
+        self.rows = 0
+        self.file_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def writerows(self, rows):
+        while rows:
+            if not self.is_open() or self.is_full():
+                self.roll()
+
+            count = len(rows)
+            if self.max_rows:
+                count = min(count, self.max_rows - self.file_rows)
+            self.write_batch(rows[:count])
+            self.file_rows += count
+            self.rows += count
+            rows = rows[count:]
+
+    def close(self):
+        """Closes the current file and returns the (file, rows) pairs written."""
+        if self.is_open():
+            self.close_file()
+            self.files[-1] = (self.files[-1][0], self.file_rows)
+        elif not self.files:
+            # keep an empty file with only the header
+            self.roll()
+            self.close_file()
+        return self.files
+
+    def roll(self):
+        if self.is_open():
+            self.close_file()
+            self.files[-1] = (self.files[-1][0], self.file_rows)
+
+        if self.max_rows or self.max_bytes:
+            root, suffix = split_suffix(self.path)
+            path = '{}-{:04d}{}'.format(root, len(self.files) + 1, suffix)
+        else:
+            path = self.path
+        self.open_file(path)
+        self.files.append((path, 0))
+        self.file_rows = 0
+
+    def is_full(self):
+        if self.max_rows and self.file_rows >= self.max_rows:
+            return True
+        return bool(self.max_bytes) and self.file_bytes() >= self.max_bytes
+
+
+class CsvSink(_RollingSink):
+    """Writes csv rows, gzip/bz2/xz compressed by the file suffix."""
+
+    def __init__(self, path, header=None, max_rows=None, max_bytes=None, write_header=True):
+        super().__init__(path, header, max_rows, max_bytes)
+        self.write_header = write_header
+        self.f = None
+        self.counter = None
+        self.writer = None
+
+    def is_open(self):
+        return self.f is not None
+
+    def open_file(self, path):
+        self.f = open_text(path)
+        self.counter = _CountingWriter(self.f)
+        self.writer = csv.writer(self.counter, quoting=csv.QUOTE_ALL)
+        if self.header and self.write_header:
+            self.writer.writerow(self.header)
+
+    def close_file(self):
+        self.f.close()
+        self.f = None
+
+    def file_bytes(self):
+        return self.counter.bytes
+
+    def write_batch(self, rows):
+        self.writer.writerows(rows)
+
+
+class ParquetSink(_RollingSink):
+    """Writes rows as parquet with string columns, requires pyarrow."""
+
+    def __init__(self, path, header, max_rows=None, max_bytes=None):
+        import pyarrow
+        import pyarrow.parquet
+
+        super().__init__(path, header, max_rows, max_bytes)
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.schema = pyarrow.schema([(name, pyarrow.string()) for name in header])
+        self.writer = None
+        self.bytes = 0
+
+    def is_open(self):
+        return self.writer is not None
+
+    def open_file(self, path):
+        self.writer = self.pq.ParquetWriter(path, self.schema, compression='zstd')
+        self.bytes = 0
+
+    def close_file(self):
+        self.writer.close()
+        self.writer = None
+
+    def file_bytes(self):
+        return self.bytes
+
+    def write_batch(self, rows):
+        columns = [[None if value is None else str(value) for value in column] for column in zip(*rows)]
+        batch = self.pa.record_batch(columns, schema=self.schema)
+        self.writer.write_batch(batch)
+        self.bytes += batch.nbytes
+
+
+class ThreadedSink:
+    """Hands batches to a background thread through a bounded queue, so formatting and compression
+    run while the caller keeps reading from the database.
+    """
+    _DONE = object()
+
+    def __init__(self, sink, queue_size=QUEUE_SIZE):
+        self.sink = sink
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def files(self):
+        return self.sink.files
+
+    def writerows(self, rows):
+        if self.error:
+            raise self.error
+        self.queue.put(list(rows))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(self._DONE)
+            self.thread.join()
+        if self.error:
+            raise self.error
+        return self.sink.files
+
+    def __run(self):
+        try:
+            while True:
+                rows = self.queue.get()
+                if rows is self._DONE:
+                    break
+                self.sink.writerows(rows)
+        except Exception as x:
+            logger.error('Error when writing to: {}. Details: {}'.format(self.sink.path, x))
+            self.error = x
+            # drain so the producer never blocks on a dead writer
+            while self.queue.get() is not self._DONE:
+                pass
+        finally:
+            self.sink.close()
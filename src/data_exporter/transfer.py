@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""Streams rows between the Mongo collection and the MySQL table without a csv round trip.
+
+Batches are read from the source in primary key order and handed to the target's bulk writer through a
+BatchPipeline. The last key of every stored batch is saved as a watermark, so an interrupted transfer
+resumes after it. Progress is logged while the transfer runs.
+
+    python transfer.py mongo-to-mysql --loader core --writers 2
+    python transfer.py mysql-to-mongo --typed
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from itertools import islice
+from logging.handlers import RotatingFileHandler
+
+import pymongo
+from sqlalchemy import func
+
+import csv_to_mongodb
+import csv_to_mysql
+from checkpoint import CHECKPOINT_DIR, Watermark
+from dedup_index import dedup_key, make_hash
+from metrics import Metrics, metrics_path
+from mongo_to_csv import MongoToFile
+from pipeline import BatchPipeline
+from schema import FIELD_NAMES, FLOAT_FIELDS, INT_FIELDS, RowMapper, TypedFields
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 10000
+PIPELINE_WRITERS = 0
+PROGRESS_INTERVAL = 10.0
+NUMERIC_FIELDS = FLOAT_FIELDS + INT_FIELDS
+# run metrics, .json or a Prometheus textfile (.prom), {file} is the transfer direction
+METRICS_PATH = None
+
+
+def setup_logger():
+    logger.setLevel(logging.DEBUG)
+
+    # create formatter and add it to the handlers
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    # create file handler which logs even debug messages
+    fh = RotatingFileHandler('csv_cleaner.log', maxBytes=10 * 1024 * 1024, backupCount=5)
+    fh.setLevel(logging.INFO)
+    fh.setFormatter(formatter)
+
+    # create console handler with a higher log level
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    ch.setFormatter(formatter)
+
+    # add the handlers to the logger
+    logger.addHandler(fh)
+    logger.addHandler(ch)
+
+
+def plain(record):
+    """Values as the csv ingesters store them in the untyped schema, strings with '' for missing."""
+    return ['' if value is None else value if isinstance(value, str) else str(value) for value in record]
+
+
+def progress_logger(job, total=None, done=0, interval=PROGRESS_INTERVAL):
+    """Returns a metrics callback which logs the rows copied and the rate, at most every `interval` seconds.
+    `done` counts the rows copied by earlier, interrupted runs.
+    """
+    last = [time.time()]
+
+    def log(event, snapshot):
+        now = time.time()
+        if event == 'flush' and now - last[0] < interval:
+            return
+        last[0] = now
+        rows = done + snapshot['counters'].get('rows_written', 0)
+        rate = snapshot['counters'].get('rows_written', 0) / snapshot['elapsed'] if snapshot['elapsed'] else 0
+        if total:
+            logger.info('{}: {} of {} rows ({:.1%}), {:.0f} rows/s.'.format(job, rows, total, rows / total, rate))
+        else:
+            logger.info('{}: {} rows, {:.0f} rows/s.'.format(job, rows, rate))
+
+    return log
+
+
+class TransferKeys:
+    """Dedup keys of the target: the stored ones and those of the batches in flight, which move over once stored."""
+
+    def __init__(self, stored):
+        self.stored = stored
+        self.inflight = set()
+
+    def __contains__(self, key):
+        return key in self.inflight or key in self.stored
+
+    def add(self, key):
+        self.inflight.add(key)
+
+    def commit(self, keys):
+        self.stored.update(keys)
+        self.inflight.difference_update(keys)
+
+
+def skip_stored(batches, keys, metrics):
+    """Takes (position, [(key, record), ...]) batches and drops the records whose key is stored already or was
+    seen earlier in the transfer. Yields (position, records, their keys) for copy_batches.
+    """
+    for position, batch in batches:
+        records = []
+        batch_keys = []
+        for key, record in batch:
+            if key in keys:
+                continue
+            keys.add(key)
+            records.append(record)
+            batch_keys.append(key)
+        metrics.incr('rows_read', len(batch))
+        metrics.incr('duplicates', len(batch) - len(records))
+        yield position, records, batch_keys
+
+
+def copy_batches(batches, open_writer, metrics, watermark=None, done=0, writers=PIPELINE_WRITERS, keys=None):
+    """Submits (position, batch) pairs, or (position, batch, batch keys) with `keys`, to the target writer and
+    returns the number of rows copied. The watermark moves to a batch's position once the batch and every one
+    before it are stored, the batch keys are then committed to `keys`.
+    """
+    copied = 0
+
+    def commit(result, token, seconds):
+        nonlocal copied
+        position, rows, batch_keys = token
+        copied += rows
+        metrics.observe_flush(seconds, rows)
+        if keys is not None:
+            keys.commit(batch_keys)
+        if watermark:
+            watermark.save(position, done + copied)
+
+    laps = metrics.laps()
+    with BatchPipeline(open_writer, commit, writers) as pipeline:
+        for item in batches:
+            laps.lap('fetch')
+            if keys is not None:
+                position, batch, batch_keys = item
+            else:
+                position, batch = item
+                batch_keys = None
+                metrics.incr('rows_read', len(batch))
+            pipeline.submit(batch, (position, len(batch), batch_keys))
+            laps.lap('flush')
+    laps.lap('flush')
+    metrics.add_section('pipeline', pipeline.stats())
+    return copied
+
+
+def mongo_batches(collection, query=None, after=None, batch_size=BATCH_SIZE, convert=None):
+    """Yields (last _id, records) batches of the documents matching `query` in _id order, after `after`."""
+    if after is not None:
+        resume = {'_id': {'$gt': after}}
+        query = {'$and': [query, resume]} if query else resume
+    projection = dict.fromkeys(FIELD_NAMES, 1)
+    cursor = collection.find(query or {}, projection=projection, batch_size=batch_size)
+    cursor = cursor.sort('_id', pymongo.ASCENDING)
+
+    buffer = []
+    last_id = None
+    for doc in cursor:
+        buffer.append(convert(doc) if convert else doc)
+        last_id = doc['_id']
+        if len(buffer) >= batch_size:
+            yield last_id, buffer
+            buffer = []
+    if buffer:
+        yield last_id, buffer
+
+
+def mysql_batches(converter, after=None, batch_size=BATCH_SIZE, convert=None):
+    """Yields (last id, records) batches of the table in id order after `after`, read by keyset pagination."""
+    model = converter.model
+    columns = [getattr(model, field) for field in FIELD_NAMES]
+    rows = converter.keyset_scan(model.id, *columns, batch_size=batch_size, start=after)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        yield batch[-1][0], [convert(row[1:]) if convert else row[1:] for row in batch]
+
+
+def mongo_to_mysql(query=None, loader=csv_to_mysql.LOADER, typed=csv_to_mysql.TYPED_SCHEMA, engine=None,
+                   batch_size=BATCH_SIZE, writers=PIPELINE_WRITERS, checkpoint_dir=CHECKPOINT_DIR,
+                   metrics_callbacks=None, metrics_path_template=METRICS_PATH, dedup_index_path=None):
+    """Copies the documents matching `query` into the MySQL table, returns the number of rows copied.
+    Documents whose Name and full_address are in the table already, from csv or an earlier transfer, are skipped
+    like the csv ingester skips them, through the dedup index at `dedup_index_path` or the keys of the table.
+    """
+    mapper = RowMapper()
+
+    with MongoToFile(None) as source, \
+            csv_to_mysql.CsvToDbConverter(dedup_index_path=dedup_index_path, loader=loader, engine=engine,
+                                          typed=typed) as target:
+        typed_fields = TypedFields(mapper.field_names, target.widths) if typed else None
+        # rows are tagged with the collection as their input file
+        label = 'mongo:{}'.format(source.mongo_collection)
+
+        def to_record(doc):
+            record = list(mapper.from_document(doc))
+            # keyed before typing, as the csv ingester does
+            key = dedup_key(*mapper.key(record))
+            record = typed_fields.parse(record) if typed_fields else plain(record)
+            record.append(label)
+            return key, record
+
+        name = 'mongo_to_mysql:{}.{}:{}'.format(source.mongo_db, source.mongo_collection,
+                                                 json.dumps(query, sort_keys=True, default=str))
+        watermark = Watermark(name, checkpoint_dir) if checkpoint_dir else None
+        after, done = watermark.load() if watermark else (None, 0)
+        if query:
+            total = source.collection.count_documents(query)
+        else:
+            total = source.collection.estimated_document_count()
+
+        callbacks = list(metrics_callbacks or []) + [progress_logger('mongo_to_mysql', total, done)]
+        metrics = Metrics('mongo_to_mysql', {'source': source.mongo_collection,
+                                             'target': target.model.__tablename__}, callbacks)
+        logger.info('Copying {} documents from {} into {}.'.format(total, source.mongo_collection,
+                                                                   target.model.__tablename__))
+        if dedup_index_path and not os.path.exists(dedup_index_path):
+            target.rebuild_dedup_index(dedup_index_path)
+        keys = TransferKeys(target.dedup_keys())
+        batches = skip_stored(mongo_batches(source.collection, query, after, batch_size, to_record), keys, metrics)
+        # writer threads can not share a session, each opens its own
+        copied = copy_batches(batches, target.open_writer, metrics, watermark, done, writers, keys)
+        logger.info('Skipped {} duplicate rows.'.format(metrics.counters.get('duplicates', 0)))
+        if watermark:
+            watermark.clear()
+        if typed_fields:
+            typed_fields.report(source.mongo_collection)
+        metrics.finish(metrics_path(metrics_path_template, 'mongo_to_mysql'))
+        return copied
+
+
+def mysql_to_mongo(typed=csv_to_mongodb.TYPED_SCHEMA, engine=None, unique_hash=csv_to_mongodb.UNIQUE_HASH_INDEX,
+                   batch_size=BATCH_SIZE, writers=PIPELINE_WRITERS, checkpoint_dir=CHECKPOINT_DIR,
+                   metrics_callbacks=None, metrics_path_template=METRICS_PATH):
+    """Copies the MySQL table into the Mongo collection, returns the number of rows copied.
+    Documents get the `hash` of the csv ingester and the table name as `file`, so duplicates are removed
+    the same way afterwards unless the unique hash index rejects them on insert.
+    """
+    typed_fields = TypedFields(FIELD_NAMES) if typed else None
+
+    with csv_to_mysql.CsvToDbConverter(engine=engine, typed=typed) as source, \
+            csv_to_mongodb.CsvToDbConverter(unique_hash=unique_hash, typed=typed) as target:
+        label = 'mysql:{}'.format(source.model.__tablename__)
+
+        def to_document(values):
+            record = typed_fields.parse(list(values)) if typed_fields else plain(values)
+            doc = dict(zip(FIELD_NAMES, record))
+            doc['hash'] = make_hash(doc['Name'], doc['full_address'])
+            doc['file'] = label
+            if typed_fields:
+                # empty or unparsable numbers are left out of the document
+                for field in NUMERIC_FIELDS:
+                    if doc[field] is None:
+                        del doc[field]
+            return doc
+
+        name = 'mysql_to_mongo:{}:{}.{}'.format(label, target.mongo_db, target.mongo_collection)
+        watermark = Watermark(name, checkpoint_dir) if checkpoint_dir else None
+        after, done = watermark.load() if watermark else (None, 0)
+        session = source.Session()
+        try:
+            total = session.query(func.count(source.model.id)).scalar()
+        finally:
+            session.close()
+
+        callbacks = list(metrics_callbacks or []) + [progress_logger('mysql_to_mongo', total, done)]
+        metrics = Metrics('mysql_to_mongo', {'source': source.model.__tablename__,
+                                             'target': target.mongo_collection}, callbacks)
+        logger.info('Copying {} rows from {} into {}.'.format(total, source.model.__tablename__,
+                                                              target.mongo_collection))
+        # pymongo clients are thread safe, the writers share the collection
+        copied = copy_batches(mysql_batches(source, after, batch_size, to_document),
+                              lambda: (target.insert, None), metrics, watermark, done, writers)
+        if watermark:
+            watermark.clear()
+        if typed_fields:
+            typed_fields.report(label)
+        if not unique_hash:
+            target.remove_duplicates(label)
+        metrics.finish(metrics_path(metrics_path_template, 'mysql_to_mongo'))
+        return copied
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('direction', choices=['mongo-to-mysql', 'mysql-to-mongo'])
+    parser.add_argument('--query', type=json.loads, help='mongo filter as json, mongo-to-mysql only')
+    parser.add_argument('--loader', default=csv_to_mysql.LOADER, help='csv_to_mysql loader: orm, core or load_data')
+    parser.add_argument('--typed', action='store_true', help='numeric schema on both sides')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--writers', type=int, default=PIPELINE_WRITERS, help='pipeline writer threads')
+    parser.add_argument('--checkpoint-dir', default=CHECKPOINT_DIR)
+    parser.add_argument('--metrics', default=METRICS_PATH, help='metrics .json or .prom path')
+    args = parser.parse_args()
+
+    setup_logger()
+    try:
+        if args.direction == 'mongo-to-mysql':
+            dedup_index_path = csv_to_mysql.DEDUP_INDEX_PATH if csv_to_mysql.USE_DEDUP_INDEX else None
+            mongo_to_mysql(args.query, args.loader, args.typed, batch_size=args.batch_size, writers=args.writers,
+                           checkpoint_dir=args.checkpoint_dir, metrics_path_template=args.metrics,
+                           dedup_index_path=dedup_index_path)
+        else:
+            mysql_to_mongo(args.typed, batch_size=args.batch_size, writers=args.writers,
+                           checkpoint_dir=args.checkpoint_dir, metrics_path_template=args.metrics)
+    except Exception as x:
+        # the watermark keeps the last stored batch, run again to resume
+        logger.error('Error when transfer {}. Details: {}'.format(args.direction, x))
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""Watch mode: ingests csv files as they land in the input directory, with one long lived client or engine.
+
+    python watch.py mongo --directory ./csv_data
+    python watch.py mysql --poll-interval 10
+"""
+import argparse
+import ctypes
+import ctypes.util
+import fnmatch
+import glob
+import logging
+import os
+import select
+import signal
+import struct
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 5.0
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+
+def setup_logger():
+    logger.setLevel(logging.DEBUG)
+
+    # create formatter and add it to the handlers
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    # create file handler which logs even debug messages
+    fh = RotatingFileHandler('csv_cleaner.log', maxBytes=10 * 1024 * 1024, backupCount=5)
+    fh.setLevel(logging.INFO)
+    fh.setFormatter(formatter)
+
+    # create console handler with a higher log level
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    ch.setFormatter(formatter)
+
+    # add the handlers to the logger
+    logger.addHandler(fh)
+    logger.addHandler(ch)
+
+
+def _libc_inotify():
+    """Returns libc when it provides inotify (Linux), None elsewhere."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+class DirectoryWatcher:
+    """Yields lists of complete files matching `pattern` in `directory`: the files already there, then new
+    ones as they land, until `stop` is called or SIGINT/SIGTERM arrives.
+
+    On Linux inotify reports a file once its writer closed it or it was moved in. Elsewhere, or when inotify
+    is not available, the directory is polled every `poll_interval` seconds and a file is taken once its size
+    and mtime held still for a whole interval. The same file is yielded again when it changes later,
+    telling new from modified files is left to the IngestManifest.
+    """
+
+    def __init__(self, directory, pattern='*.csv', poll_interval=POLL_INTERVAL, use_inotify=True):
+        self.directory = directory
+        self.pattern = pattern
+        self.poll_interval = poll_interval
+        self.libc = _libc_inotify() if use_inotify else None
+        self.stopped = False
+
+    def stop(self, *args):
+        self.stopped = True
+
+    def __iter__(self):
+        previous = {}
+        # handlers can only be set from the main thread, elsewhere the caller stops the watcher
+        if threading.current_thread() is threading.main_thread():
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                previous[sig] = signal.signal(sig, self.stop)
+        try:
+            fd = self.__inotify_fd()
+            if fd is None:
+                logger.info('Watching {} by polling every {}s.'.format(self.directory, self.poll_interval))
+                yield from self.__poll()
+            else:
+                logger.info('Watching {} with inotify.'.format(self.directory))
+                try:
+                    yield from self.__inotify(fd)
+                finally:
+                    os.close(fd)
+        finally:
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+        logger.info('Stopped watching {}.'.format(self.directory))
+
+    def scan(self):
+        return sorted(glob.glob(os.path.join(self.directory, self.pattern)))
+
+    def __inotify_fd(self):
+        if self.libc is None:
+            return None
+        fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            logger.warning('inotify is not available: {}'.format(os.strerror(ctypes.get_errno())))
+            return None
+        if self.libc.inotify_add_watch(fd, os.fsencode(self.directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            logger.warning('Can not watch {}: {}'.format(self.directory, os.strerror(ctypes.get_errno())))
+            os.close(fd)
+            return None
+        return fd
+
+    def __settled(self, paths):
+        """Keeps the paths whose size and mtime do not change within one interval."""
+        before = {path: self.__stat(path) for path in paths}
+        time.sleep(self.poll_interval)
+        return [path for path in paths if before[path] is not None and self.__stat(path) == before[path]]
+
+    def __inotify(self, fd):
+        # files written while starting up are reported by their close event
+        existing = self.__settled(self.scan())
+        if existing:
+            yield existing
+
+        while not self.stopped:
+            try:
+                ready, _, _ = select.select([fd], [], [], self.poll_interval)
+            except InterruptedError:
+                continue
+            if not ready:
+                continue
+
+            names = set()
+            overflow = False
+            data = os.read(fd, READ_SIZE)
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+                offset += EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                elif name:
+                    names.add(os.fsdecode(name))
+
+            if overflow:
+                # events were dropped, the manifest skips what is unchanged
+                logger.warning('inotify queue overflow, rescanning {}.'.format(self.directory))
+                paths = self.scan()
+            else:
+                paths = sorted(os.path.join(self.directory, name) for name in names
+                               if fnmatch.fnmatch(name, self.pattern))
+            paths = [path for path in paths if os.path.isfile(path)]
+            if paths:
+                yield paths
+
+    def __poll(self):
+        sizes = {}
+        taken = {}
+        while not self.stopped:
+            ready = []
+            current = {}
+            for path in self.scan():
+                stat = self.__stat(path)
+                if stat is None:
+                    continue
+                current[path] = stat
+                # unchanged since the last poll and not taken in this state yet
+                if sizes.get(path) == stat and taken.get(path) != stat:
+                    taken[path] = stat
+                    ready.append(path)
+            sizes = current
+            if ready:
+                yield ready
+
+            deadline = time.time() + self.poll_interval
+            while not self.stopped and time.time() < deadline:
+                time.sleep(min(0.5, self.poll_interval))
+
+    @staticmethod
+    def __stat(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('target', choices=['mongo', 'mysql'])
+    parser.add_argument('--directory', default='./csv_data')
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL,
+                        help='seconds between polls, or a file must hold still before it is taken')
+    args = parser.parse_args()
+
+    if args.target == 'mongo':
+        import csv_to_mongodb as ingester
+    else:
+        import csv_to_mysql as ingester
+    # the ingester imports this file as the watch module, that is the logger the watcher writes to
+    import csv_ingest
+    import watch
+    watch.setup_logger()
+    csv_ingest.setup_logger()
+    ingester.setup_logger()
+
+    dedup_index_path = ingester.DEDUP_INDEX_PATH if ingester.USE_DEDUP_INDEX else None
+    ingester.watch_files(args.directory, dedup_index_path, poll_interval=args.poll_interval)